@@ -0,0 +1,43 @@
+import random
+import sys
+import time
+import casper
+
+# Benchmark of publish(): time to broadcast a round of signatures, one
+# from every validator, comparing the grouped broadcast against queueing
+# every validator separately with its own latency draw.
+#
+# Usage: python bench_publish.py [rounds]
+
+
+def publish_per_validator(obj):
+    for v in casper.validators:
+        arrival_time = casper.real_time[0] + casper.latency_distribution_sample()
+        if arrival_time not in casper.listening_queue:
+            casper.listening_queue[arrival_time] = []
+        casper.listening_queue[arrival_time].append((v, obj))
+
+
+def bench(publish, num_validators, rounds):
+    random.seed(num_validators)
+    casper.validators.clear()
+    casper.listening_queue.clear()
+    for i in range(num_validators):
+        casper.validators[i] = None
+    view = [casper.assign_hash() for i in range(10)]
+    t = time.time()
+    for r in range(rounds):
+        for i in range(num_validators):
+            publish(casper.Signature(i, view, len(view)))
+        casper.real_time[0] += casper.BLKTIME
+    return time.time() - t
+
+
+rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+for num_validators in (50, 500, 5000):
+    # Give the smaller networks more rounds, to get measurable times
+    r = max(rounds, rounds * 500 // num_validators)
+    t_grouped = bench(casper.publish, num_validators, r)
+    t_single = bench(publish_per_validator, num_validators, r)
+    print '%d validators, %d rounds: grouped %.3fs, per validator %.3fs (%.1fx)' % \
+        (num_validators, r, t_grouped, t_single, t_single / t_grouped)
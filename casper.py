@@ -1,4 +1,5 @@
-import copy, random, hashlib
+import random, hashlib, math
+import tracesink
 # GhostTable: { block number: { block: validators } }
 # The ghost table represents the entire current "view" of a user, and
 # every block produced contains the producer's ghost table at the time.
@@ -21,6 +22,7 @@ CLOCK_DISPARITY = 10
 LATENCY_MIN = 4
 LATENCY_BASE = 2
 LATENCY_PROB = 0.25
+LOG_LATENCY_Q = math.log(1 - LATENCY_PROB)
 
 
 def assign_hash():
@@ -40,6 +42,15 @@ def latency_distribution_sample():
     return v + LATENCY_MIN
 
 
+# Latencies for n recipients at once, from the same distribution. The
+# number of doublings is geometric, so it can be drawn from a single
+# uniform number instead of a loop of coin flips
+def latency_distribution_samples(n):
+    r = random.random
+    return [(LATENCY_BASE << int(math.log(1.0 - r()) / LOG_LATENCY_Q)) + LATENCY_MIN
+            for i in xrange(n)]
+
+
 def clock_offset_distribution_sample():
     return random.randrange(-CLOCK_DISPARITY, CLOCK_DISPARITY)
 
@@ -47,56 +58,127 @@ def clock_offset_distribution_sample():
 # A signature represents the entire "view" of a signer,
 # where the view is the set of blocks that the signer
 # considered most likely to be valid at the time that
-# they were produced
+# they were produced. A validator's view only ever has blocks
+# added at empty heights, so the signature shares the signer's
+# view list and just records how far into it the signature goes
 class Signature():
 
-    def __init__(self, signer, view):
+    def __init__(self, signer, view, length):
         self.signer = signer
-        self.view = copy.deepcopy(view)
+        self._view = view
+        self.length = length
+
+    @property
+    def view(self):
+        return self._view[:self.length]
+
+
+# An append-only list that can be forked cheaply: forks share one
+# backing list, and each only sees its first n items. A fork that
+# appends after another fork already has copies its items first
+class SharedPrefix():
+
+    def __init__(self, items=None, n=0):
+        self.items = items if items is not None else []
+        self.n = n
+
+    def fork(self):
+        return SharedPrefix(self.items, self.n)
+
+    def append(self, x):
+        if len(self.items) != self.n:
+            self.items = self.items[:self.n]
+        self.items.append(x)
+        self.n += 1
+
+    def __len__(self):
+        return self.n
+
+    def to_list(self):
+        return self.items[:self.n]
 
 
 # A ghost table represents the view that a user had of the signatures
 # available at the time that the block was produced.
+#
+# Ghost tables are persistent: appending to one makes a new table that
+# shares structure with the old one, which stays as it was. Entries at
+# confirmed heights never change again, so they are kept in a list
+# shared by every table descended from the one that confirmed them. The
+# entries from the first unconfirmed height up are copied by reference,
+# and an entry is only copied when a table first adds a signer to it.
 class GhostTable():
 
     def __init__(self):
-        self.confirmed = []
-        self.unconfirmed = []
+        # Confirmed block hashes by height
+        self._confirmed = SharedPrefix()
+        # Ghost table entries at the confirmed heights
+        self._settled = SharedPrefix()
+        # Ghost table entries from the first unconfirmed height up
+        self._window = []
+        # Heights in the window whose entries belong to this table alone
+        self._owned = set()
+
+    @property
+    def confirmed(self):
+        return self._confirmed.to_list()
+
+    @property
+    def unconfirmed(self):
+        return self._settled.to_list() + self._window
+
+    # The ghost table entry at a height at or above the first
+    # unconfirmed one, copied first if it is shared with another table
+    def _writable_entry(self, i):
+        k = i - len(self._settled)
+        if k == len(self._window):
+            self._window.append({})
+        elif i not in self._owned:
+            self._window[k] = {b: dict(s) for b, s in self._window[k].items()}
+        self._owned.add(i)
+        return self._window[k]
 
     def process_signature(self, sig):
         # Process every block height in the signature
-        for i in range(len(self.confirmed), len(sig.view)):
+        for i in range(len(self._confirmed), sig.length):
             # A ghost table entry at a height is a mapping of
             # block hash -> signers
-            if i >= len(self.unconfirmed):
-                self.unconfirmed.append({})
-            cur_entry = self.unconfirmed[i]
+            cur_entry = self._writable_entry(i)
             # If the block hash is not yet in the ghost table, add it, and
             # initialize it with an empty signer set
-            if sig.view[i] not in cur_entry:
-                cur_entry[sig.view[i]] = {}
+            block = sig._view[i]
+            if block not in cur_entry:
+                cur_entry[block] = {}
             # Add the signer
-            cur_entry[sig.view[i]][sig.signer] = True
+            cur_entry[block][sig.signer] = True
             # If it has 67% signatures, finalize
-            if len(cur_entry[sig.view[i]]) > NUM_VALIDATORS * 2 / 3:
-                # prevgt = block_map[sig.view[i]].gt
+            if len(cur_entry[block]) > NUM_VALIDATORS * 2 / 3:
+                # prevgt = block_map[block].gt
                 prevgt = self
-                print 'confirmed', block_map[sig.view[i]].height, sig.view[i]
                 # Update blocks between the previous confirmation and the
                 # current confirmation based on the newly confirmed block's
                 # ghost table
-                for j in range(len(self.confirmed), i):
+                first = len(self._confirmed)
+                for j in range(first, i):
                     # At each intermediate height, add the block for which we
                     # havethe most signatures
+                    entry = prevgt._window[j - first]
                     maxkey, maxval = 0, 0
-                    for k in prevgt.unconfirmed[j]:
-                        if len(prevgt.unconfirmed[j][k]) > maxval:
-                            maxkey, maxval = k, len(prevgt.unconfirmed[j][k])
-                    self.confirmed.append(maxkey)
-                    print j, {k: len(prevgt.unconfirmed[j][k]) for k in prevgt.unconfirmed[j]}
+                    for k in entry:
+                        if len(entry[k]) > maxval:
+                            maxkey, maxval = k, len(entry[k])
+                    self._confirmed.append(maxkey)
+                    if tracesink.level >= tracesink.DETAIL:
+                        tracesink.emit(tracesink.DETAIL, 'confirmed_by_votes', height=j, block=maxkey,
+                                       votes={k: len(entry[k]) for k in entry})
                 # Then add the new block that got 67% signatures
-                print i, sig.view[i]
-                self.confirmed.append(sig.view[i])
+                if tracesink.level >= tracesink.EVENT:
+                    tracesink.emit(tracesink.EVENT, 'confirmed', height=block_map[block].height, block=block)
+                self._confirmed.append(block)
+                # The entries up to here are now settled
+                for entry in self._window[:i + 1 - first]:
+                    self._settled.append(entry)
+                self._window = self._window[i + 1 - first:]
 
     # Hash of the ghost table's contents (to make sure that it's not
     # being modified when it's already supposed to be set in stone)
@@ -108,8 +190,11 @@ class GhostTable():
     # some set of signatures
     def append(self, sigs):
         x = GhostTable()
-        x.confirmed = copy.deepcopy(self.confirmed)
-        x.unconfirmed = copy.deepcopy(self.unconfirmed)
+        x._confirmed = self._confirmed.fork()
+        x._settled = self._settled.fork()
+        x._window = list(self._window)
+        # Both tables now share every entry in the window
+        self._owned = set()
         for sig in sigs:
             x.process_signature(sig)
         return x
@@ -154,10 +239,11 @@ class Validator():
     def produce_block(self):
         self.gt = self.gt.append(self.new_sigs)
         newblk = Block(self.last_unseen, self.gt, self.id)
-        print 'newblk', newblk.height
+        if tracesink.level >= tracesink.EVENT:
+            tracesink.emit(tracesink.EVENT, 'block', height=newblk.height, maker=self.id, time=real_time[0])
         self.add_to_view(newblk)
         publish(newblk)
-        newsig = Signature(self.id, self.view[:self.last_unseen])
+        newsig = Signature(self.id, self.view, self.last_unseen)
         self.new_sigs = [newsig]
         publish(newsig)
 
@@ -168,7 +254,7 @@ class Validator():
             if 0 <= (desired_maker - obj.maker) % 100 <= 0:
                 if self.is_compatible_with_view(obj):
                     self.add_to_view(obj)
-                    publish(Signature(self.id, self.view[:self.last_unseen]))
+                    publish(Signature(self.id, self.view, self.last_unseen))
         if isinstance(obj, Signature):
             self.new_sigs.append(obj)
 
@@ -197,13 +283,20 @@ validators = {}
 def publish(obj):
     if isinstance(obj, Block):
         block_map[obj.hash] = obj
-    # For every validator, add it to the validator's listening queue
-    # at a time randomly sampled from the latency distribution
-    for v in validators:
-        arrival_time = real_time[0] + latency_distribution_sample()
+    # Draw every validator's latency at once, and group the validators
+    # by arrival time, so the object is queued once per arrival time
+    # along with the validators it reaches then
+    groups = {}
+    for v, latency in zip(validators, latency_distribution_samples(len(validators))):
+        if latency in groups:
+            groups[latency].append(v)
+        else:
+            groups[latency] = [v]
+    for latency, recipients in groups.items():
+        arrival_time = real_time[0] + latency
         if arrival_time not in listening_queue:
             listening_queue[arrival_time] = []
-        listening_queue[arrival_time].append((v, obj))
+        listening_queue[arrival_time].append((recipients, obj))
 
 
 # One round of the clock ticking
@@ -211,10 +304,12 @@ def tick():
     for _, v in validators.items():
         v.tick()
     if real_time[0] in listening_queue:
-        for validator_id, obj in listening_queue[real_time[0]]:
-            validators[validator_id].on_receive(obj)
+        for recipients, obj in listening_queue.pop(real_time[0]):
+            for validator_id in recipients:
+                validators[validator_id].on_receive(obj)
     real_time[0] += 1
-    print real_time[0]
+    if tracesink.level >= tracesink.DETAIL:
+        tracesink.emit(tracesink.DETAIL, 'tick', time=real_time[0])
 
 
 # Main function: run(7000) = simulate casper for 7000 ticks
@@ -232,6 +327,7 @@ def run(steps):
         validators[v.id] = v
     for i in range(steps):
         tick()
+    tracesink.flush()
     c = []
     for _, v in validators.items():
         for i, b in enumerate(v.gt.confirmed):
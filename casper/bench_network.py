@@ -0,0 +1,69 @@
+import random
+import sys
+import time
+import networksim
+
+# Benchmark of the network simulator under a storm of direct requests,
+# comparing ID-indexed direct_send against the old linear agent scan.
+#
+# Usage: python bench_network.py [steps]
+
+
+class Request():
+    def __init__(self, sender):
+        self.sender = sender
+
+
+class Reply():
+    def __init__(self, sender):
+        self.sender = sender
+
+
+# An agent that keeps asking its peers for things; every request gets
+# answered with a direct_send back to the requester
+class RequestingAgent():
+    def __init__(self, id, network, request_rate=0.1):
+        self.id = id
+        self.network = network
+        self.request_rate = request_rate
+        self.replies = 0
+
+    def next_wakeup(self):
+        return self.network.time
+
+    def tick(self):
+        if random.random() < self.request_rate:
+            self.network.broadcast(self, Request(self.id))
+
+    def on_receive(self, obj):
+        if isinstance(obj, Request):
+            self.network.direct_send(obj.sender, Reply(self.id))
+        else:
+            self.replies += 1
+
+
+class LinearScanSimulator(networksim.NetworkSimulator):
+    def direct_send(self, to_id, obj):
+        for a in self.agents:
+            if a.id == to_id:
+                recv_time = self.time + self.latency_distribution_sample()
+                self.enqueue(recv_time, a, obj)
+
+
+def bench(simulator_class, num_agents, steps):
+    random.seed(num_agents)
+    n = simulator_class(latency=100)
+    for i in range(num_agents):
+        n.add_agent(RequestingAgent(i, n))
+    n.generate_peers(3)
+    t = time.time()
+    n.run(steps)
+    return time.time() - t, sum([a.replies for a in n.agents])
+
+
+steps = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+for num_agents in (20, 200, 2000):
+    t_indexed, replies = bench(networksim.NetworkSimulator, num_agents, steps)
+    t_linear, _ = bench(LinearScanSimulator, num_agents, steps)
+    print '%d validators, %d replies: indexed %.3fs, linear scan %.3fs (%.1fx)' % \
+        (num_agents, replies, t_indexed, t_linear, t_linear / t_indexed)
@@ -0,0 +1,21 @@
+import random
+import resource
+import sys
+import time
+import casper
+
+# Time a whole simulation and report the process's peak memory use.
+#
+# Usage: python bench_run.py [validators] [steps]
+
+casper.NUM_VALIDATORS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+steps = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+casper.CHECK_INTEGRITY = False
+random.seed(1)
+
+t = time.time()
+sim = casper.Simulation()
+sim.run(steps, verbose=False)
+print '%d validators, %d steps: %.1fs, %d signatures, peak RSS %d MB' % \
+    (casper.NUM_VALIDATORS, steps, time.time() - t, len(sim.signature_log),
+     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)
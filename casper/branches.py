@@ -0,0 +1,45 @@
+import random
+import sys
+import casper
+from casper import NetworkEvent
+
+# Simulate a common prefix once, then run several network scenarios as
+# branches forked from a snapshot of it, instead of re-simulating the
+# prefix for every scenario.
+#
+# Usage: python branches.py [prefix_steps] [branch_steps] [seed]
+
+prefix_steps = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+branch_steps = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+random.seed(int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+
+split, heal = prefix_steps, prefix_steps + branch_steps // 2
+branches = [
+    ('no netsplit', []),
+    ('20% offline', [
+        NetworkEvent(split, [('knock_offline_random', (casper.NUM_VALIDATORS // 5,))]),
+        NetworkEvent(heal, [('generate_peers', ())]),
+    ]),
+    ('50-50 partition', [
+        NetworkEvent(split, [('generate_peers', ()), ('partition', ())]),
+        NetworkEvent(heal, [('generate_peers', ())]),
+    ]),
+]
+
+sim = casper.Simulation(scenario=[])
+sim.run(prefix_steps, verbose=False)
+snapshot = sim.snapshot()
+for name, scenario in branches:
+    branch = casper.fork(snapshot)
+    branch.scenario = scenario
+    print '### Branch: %s ###' % name
+    try:
+        branch.run(branch_steps, verbose=False)
+    except Exception as e:
+        # The integrity check caught validators finalizing different blocks
+        print 'Branch failed: %s' % e
+        continue
+    finalized_hashes = branch.finalized_hashes()
+    if finalized_hashes:
+        casper.calibrate(finalized_hashes, branch.signature_log)
+    print 'Finalization heights: %r' % casper.get_finalization_heights(branch.network)
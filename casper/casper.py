@@ -3,6 +3,8 @@ from distributions import normal_distribution
 import networksim
 import voting_strategy
 import math
+import bisect
+from array import array
 
 # Number of validators
 NUM_VALIDATORS = 20
@@ -26,6 +28,14 @@ BROADCAST_SUCCESS_RATE = 0.9
 CLOCK_DISPARITY = 100
 # Finality threshold
 FINALITY_THRESHOLD = 0.000001
+# Ticks to wait for the answer to a SignatureChildRequest before asking
+# for the same range again
+SIG_REQUEST_TIMEOUT = NETWORK_LATENCY * 4
+# Draw default votes, latencies and delivery failures from per-validator
+# and per-network streams, latencies a block at a time, rather than one
+# at a time from the random module (False reproduces the results of a
+# single shared stream)
+BATCHED_SAMPLING = True
 
 logging_level = 0
 
@@ -37,17 +47,22 @@ def log(s, lvl):
 
 # A signture specifies an initial height ("sign_from"), a finalized
 # state from all blocks before that height and a list of probability
-# bets from that height up to the latest height
-class Signature():
-    def __init__(self, signer, probs, state_roots, max_height, prev):
+# bets from that height up to the latest height. Messages are slotted, as
+# every validator keeps a reference to every one it receives.
+class Signature(object):
+    __slots__ = ('signer', 'probs', 'hash', 'state_roots', 'state_from', 'max_height', 'prev', 'seq')
+
+    def __init__(self, signer, probs, state_roots, state_from, max_height, prev):
         # The ID of the signer
         self.signer = signer
-        # List of probability bets, expressed in log odds
-        self.probs = probs
+        # Array of probability bets
+        self.probs = array('d', probs)
         # Hash of the signature (for db storage purposes)
         self.hash = random.randrange(10**14)
-        # State root changes
+        # State roots finalized since the signer's previous signature, and
+        # the height of the first of them
         self.state_roots = state_roots
+        self.state_from = state_from
         # Max height
         self.max_height = max_height
         # Previous signature
@@ -61,7 +76,9 @@ class Signature():
 
 
 # Right now, a block simply specifies a proposer and a height.
-class Block():
+class Block(object):
+    __slots__ = ('maker', 'height', 'hash')
+
     def __init__(self, maker, height):
         # The producer of the block
         self.maker = maker
@@ -72,14 +89,18 @@ class Block():
 
 
 # A request to receive a block at a particular height
-class BlockRequest():
+class BlockRequest(object):
+    __slots__ = ('sender', 'ask_height', 'hash')
+
     def __init__(self, sender, height):
         self.sender = sender
         self.ask_height = height
         self.hash = random.randrange(10**14)
 
 # A request to receive the signature subsequent to a particular signature
-class SignatureChildRequest():
+class SignatureChildRequest(object):
+    __slots__ = ('sender', 'sighash', 'signer', 'ht', 'hash')
+
     def __init__(self, sender, sighash, signer, ht=0):
         self.sender = sender
         self.sighash = sighash
@@ -94,11 +115,34 @@ def state_transition(state, block):
     return state if block is None else (state ** 3 + block.hash ** 5) % 10**40
 
 
+# Memo of state_transition shared by all the validators in a simulation.
+# They all finalize the same blocks, so each transition only needs to be
+# computed once. Entries are keyed by the pre-state and the block hash
+# rather than the height, so validators that finalize different chains
+# still get their own states
+class StateCache():
+    def __init__(self):
+        self.states = {}
+
+    def transition(self, state, block):
+        if block is None:
+            return state
+        key = (state, block.hash)
+        if key not in self.states:
+            self.states[key] = state_transition(state, block)
+        return self.states[key]
+
+
 # A validator
 class Validator():
-    def __init__(self, pos, network, default_vote=voting_strategy.default_vote, vote=voting_strategy.vote):
+    def __init__(self, pos, network, default_vote=voting_strategy.default_vote, vote=voting_strategy.vote, signature_log=None, state_cache=None):
         # Map from height to {node_id: latest_bet}
         self.received_signatures = []
+        # Map from height to the sorted non-zero bets in received_signatures,
+        # and a flag per height set when a signature touches that height;
+        # sorting is done lazily when signing
+        self.sorted_votes = []
+        self.votes_dirty = bytearray()
         # List of received blocks
         self.received_blocks = []
         # Own probability estimates
@@ -117,6 +161,10 @@ class Validator():
         self.finalized_hashes = []
         # Finalized states
         self.states = []
+        # Where to get state transitions from
+        self.state_cache = state_cache if state_cache is not None else StateCache()
+        # The highest height whose state we have put in a signature
+        self.signed_state_height = -1
         # The highest height that the validator has finalized
         self.max_finalized_height = -1
         # The network object
@@ -129,9 +177,20 @@ class Validator():
         self.most_recent_sig = None
         # Most recent signatures of other validators
         self.most_recent_sigs = {}
+        # Each signer's chain of signatures that we have accepted, indexed
+        # by sequence number, and the sequence number of each by hash
+        self.sig_chains = {}
+        self.sig_seqs = {}
+        # Outstanding SignatureChildRequests: signer -> (hash we asked for
+        # the children of, time we asked)
+        self.sig_requests = {}
         # Voting methods
         self.vote = vote
         self.default_vote = default_vote
+        # Where to record the signatures we make, if anywhere
+        self.signature_log = signature_log
+        # Stream of the random numbers behind our default votes
+        self.rng = random.Random(random.getrandbits(64)) if BATCHED_SAMPLING else None
 
     # Get the local time from the point of view of this validator, using the
     # validator's offset from real time
@@ -145,28 +204,34 @@ class Validator():
     # Create a signature
     def sign(self):
         # Initialize the probability array, the core of the signature
-        best_guesses = [None] * len(self.received_blocks)
         sign_from = max(0, self.max_finalized_height - 3)
         while not self.received_blocks[sign_from] and sign_from:
             sign_from -= 1
-        for i, b in list(enumerate(self.received_blocks))[sign_from:]:
-            # print i, b
+        best_guesses = [None] * (len(self.received_blocks) - sign_from)
+        now = self.get_time()
+        rand = self.rng.random if self.rng else random.random
+        for i in range(sign_from, len(self.received_blocks)):
+            b = self.received_blocks[i]
             # Compute this validator's own initial vote based on when the block
             # was received, compared to what time the block should have arrived
             received_time = self.time_received[b.hash] if b is not None else None
-            # if received_time:
-            #     print 'delta', received_time - BLKTIME * i
-            my_opinion = self.default_vote(BLKTIME * i, received_time, self.get_time(), blktime=BLKTIME)
-            # Get others' bets on this height
-            votes = self.received_signatures[i].values() if i < len(self.received_signatures) else []
-            votes = [x for x in votes if x != 0]
+            my_opinion = self.default_vote(BLKTIME * i, received_time, now, blktime=BLKTIME, rand=rand)
+            # Get others' bets on this height, re-sorting them only if a
+            # signature has arrived for it since we last signed
+            if i < len(self.sorted_votes):
+                if self.votes_dirty[i]:
+                    self.sorted_votes[i] = sorted([x for x in self.received_signatures[i].values() if x != 0])
+                    self.votes_dirty[i] = 0
+                sorted_votes = self.sorted_votes[i]
+            else:
+                sorted_votes = []
             # Fill in the not-yet-received votes with this validator's default bet
-            votes += [my_opinion] * (NUM_VALIDATORS - len(votes))
+            votes = voting_strategy.PaddedVotes(sorted_votes, my_opinion, NUM_VALIDATORS)
             vote_from_signatures = self.vote(votes)
             # If you have not received a block, reserve judgement
             bg = min(vote_from_signatures, 1 if self.received_blocks[i] is not None else my_opinion)
             # Add the bet to the list
-            best_guesses[i] = bg
+            best_guesses[i - sign_from] = bg
             # Request a block if we should have it, and should have had it for
             # a long time, but don't
             if vote_from_signatures > 0.9 and self.received_blocks[i] is None:
@@ -175,12 +240,12 @@ class Validator():
                 if random.random() < 0.05:
                     self.broadcast(BlockRequest(self.id, i))
             # Block finalized
-            if best_guesses[i] >= 1 - FINALITY_THRESHOLD:
+            if bg >= 1 - FINALITY_THRESHOLD:
                 while len(self.finalized_hashes) <= i:
                     self.finalized_hashes.append(None)
                 self.finalized_hashes[i] = self.received_blocks[i].hash
             # Absense of the block finalized
-            elif best_guesses[i] <= FINALITY_THRESHOLD:
+            elif bg <= FINALITY_THRESHOLD:
                 while len(self.finalized_hashes) <= i:
                     self.finalized_hashes.append(None)
                 self.finalized_hashes[i] = False
@@ -190,19 +255,16 @@ class Validator():
             self.max_finalized_height += 1
             last_state = self.states[self.max_finalized_height - 1] if self.max_finalized_height else GENESIS_STATE
             assert len(self.states) == len(self.received_blocks), (len(self.states), len(self.received_blocks))
-            self.states[self.max_finalized_height] = state_transition(last_state, self.received_blocks[self.max_finalized_height])
-        self.probs = self.probs[:sign_from] + best_guesses[sign_from:]
-        new_states = [self.states[self.max_finalized_height] if self.max_finalized_height >= 0 else GENESIS_STATE]
-        diff_index = 0
-        for i in range(-1, -min(len(new_states), len(self.states))-1, -1):
-            if new_states[i] != self.states[i]:
-                self.states[i] = new_states[i]
-                diff_index = i
+            self.states[self.max_finalized_height] = self.state_cache.transition(last_state, self.received_blocks[self.max_finalized_height])
+        self.probs[sign_from:] = best_guesses
+        # Only include the states finalized since our last signature
+        state_from = self.signed_state_height + 1
+        self.signed_state_height = self.max_finalized_height
         log('Making signature: %r' % self.probs[-10:], lvl=1)
-        sign_from_state = self.states[sign_from - 1] if sign_from > 0 else GENESIS_STATE
-        s = Signature(self.pos, map(lambda x: min(1 - FINALITY_THRESHOLD, max(FINALITY_THRESHOLD, x)), self.probs[sign_from:]), self.states[diff_index:], len(self.received_blocks), self.most_recent_sig)
+        s = Signature(self.pos, map(lambda x: min(1 - FINALITY_THRESHOLD, max(FINALITY_THRESHOLD, x)), self.probs[sign_from:]), self.states[state_from:self.max_finalized_height + 1], state_from, len(self.received_blocks), self.most_recent_sig)
         self.most_recent_sig = s
-        all_signatures.append((s, self.get_time()))
+        if self.signature_log is not None:
+            self.signature_log.append(s.signer, s.probs, s.sign_from, self.get_time())
         return s
 
     def on_receive(self, obj):
@@ -236,28 +298,46 @@ class Validator():
                 sf = obj.sign_from
                 while len(self.received_signatures) <= len(obj.probs) + sf:
                     self.received_signatures.append({})
+                    self.sorted_votes.append([])
+                    self.votes_dirty.append(0)
                 for i, p in enumerate(obj.probs):
                     self.received_signatures[i + sf][obj.signer] = p
+                self.votes_dirty[sf:sf + len(obj.probs)] = b'\x01' * len(obj.probs)
                 self.network.broadcast(self, obj)
                 self.most_recent_sigs[obj.signer] = obj
+                self.sig_chains.setdefault(obj.signer, []).append(obj)
+                self.sig_seqs[obj.hash] = obj.seq
                 log('upgraded signature: '+str(obj.seq), lvl=2)
-            else:
+            elif obj.seq > latest_sig_seq:
                 # print 'newseq', obj.seq, 'oldseq', latest_sig_seq
+                # Ask once for the whole range we are missing, rather than
+                # once for every signature that arrives ahead of it
+                pending = self.sig_requests.get(obj.signer)
+                if pending and pending[0] == latest_sig_hash and \
+                        self.network.time < pending[1] + SIG_REQUEST_TIMEOUT:
+                    return
+                self.sig_requests[obj.signer] = (latest_sig_hash, self.network.time)
                 self.broadcast(SignatureChildRequest(self.id, latest_sig_hash, obj.signer, [smrs[obj.signer].seq, smrs[obj.signer].prev] if obj.signer in smrs else None))
                 return
+            else:
+                return
         elif isinstance(obj, SignatureChildRequest):
             log('Processing SignatureChildRequest', lvl=2)
-            x = [self.most_recent_sigs.get(obj.signer, None)]
-            while 1:
-                if x[-1] is None:
-                    log('SignatureChildRequest fail', lvl=2)
-                    break
-                # print x.hash, x.signer, x.seq, x.prev
-                if x[-1].prev == obj.sighash:
-                    self.network.direct_send(obj.sender, x[::-1])
-                    log('SignatureChildRequest success: %r' % [a.seq for a in x[::-1]], lvl=2)
-                    break
-                x.append(self.received_objects[x[-1].prev] if x[-1].prev is not None else None)
+            # Send everything in the signer's chain after the requested
+            # signature, or the whole chain if the requester has none of it
+            chain = self.sig_chains.get(obj.signer, [])
+            start = None
+            if obj.sighash is None:
+                start = 0
+            elif obj.sighash in self.sig_seqs:
+                seq = self.sig_seqs[obj.sighash]
+                if seq < len(chain) and chain[seq].hash == obj.sighash:
+                    start = seq + 1
+            if start is not None and start < len(chain):
+                self.network.direct_send(obj.sender, chain[start:])
+                log('SignatureChildRequest success: %r' % [a.seq for a in chain[start:]], lvl=2)
+            else:
+                log('SignatureChildRequest fail', lvl=2)
         # Received a block request, respond if we have it
         elif isinstance(obj, BlockRequest):
             if obj.ask_height < len(self.received_blocks):
@@ -266,6 +346,10 @@ class Validator():
         self.received_objects[obj.hash] = obj
         self.time_received[obj.hash] = self.get_time()
 
+    # The network time at which tick() will next make a block
+    def next_wakeup(self):
+        return BLKTIME * self.next_height - self.time_offset
+
     # Run every tick
     def tick(self):
         mytime = self.get_time()
@@ -284,12 +368,6 @@ class Validator():
             self.time_received[o.hash] = mytime
             return o
 
-validator_list = []
-future = {}
-discarded = {}
-finalized_blocks = {}
-all_signatures = []
-now = [0]
 
 
 def who_heard_of(h, n):
@@ -330,129 +408,324 @@ def get_finalization_heights(n):
     return o
 
 
+# Columnar table of signatures, holding only what the post-run analysis
+# needs: one row per signature, plus the bets of all signatures
+# concatenated into one flat array, with row i's bets at
+# probs[offsets[i]:offsets[i+1]] covering heights sign_from[i] onwards
+class SignatureColumns():
+    COLUMNS = ('signer', 'time', 'sign_from', 'offsets', 'probs')
+
+    def __init__(self):
+        self.signer = array('l')
+        self.time = array('l')
+        self.sign_from = array('l')
+        self.offsets = array('l', [0])
+        self.probs = array('d')
+
+    def append(self, signer, probs, sign_from, time):
+        self.signer.append(signer)
+        self.time.append(time)
+        self.sign_from.append(sign_from)
+        self.probs.extend(probs)
+        self.offsets.append(len(self.probs))
+
+    def __len__(self):
+        return len(self.signer)
+
+    def write(self, f):
+        array('l', [len(self), len(self.probs)]).tofile(f)
+        for c in self.COLUMNS:
+            getattr(self, c).tofile(f)
+
+    # Read the next table written to f, or None at the end of the file
+    @classmethod
+    def read(cls, f):
+        header = array('l')
+        try:
+            header.fromfile(f, 2)
+        except EOFError:
+            return None
+        o = cls()
+        o.offsets = array('l')
+        for c, size in zip(cls.COLUMNS, [header[0]] * 3 + [header[0] + 1, header[1]]):
+            getattr(o, c).fromfile(f, size)
+        return o
+
+
+# Append-only log of every signature made during a run. Rows accumulate in
+# an in-memory chunk; if a spill file is given, every chunk_size rows the
+# chunk is written out to it and dropped from memory, so the log's memory
+# use stays flat however long the run is.
+class SignatureLog():
+    def __init__(self, spill_path=None, chunk_size=20000):
+        self.spill_path = spill_path
+        self.chunk_size = chunk_size
+        self.spilled_rows = 0
+        # Length of the spill file, as written by this log. A forked log
+        # shares the file's contents up to here with its parent
+        self.spilled_bytes = 0
+        self.current = SignatureColumns()
+        if spill_path:
+            open(spill_path, 'wb').close()
+
+    def append(self, signer, probs, sign_from, time):
+        self.current.append(signer, probs, sign_from, time)
+        if self.spill_path and len(self.current) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.spill_path and len(self.current):
+            with open(self.spill_path, 'ab') as f:
+                self.current.write(f)
+                self.spilled_bytes = f.tell()
+            self.spilled_rows += len(self.current)
+            self.current = SignatureColumns()
+
+    def __len__(self):
+        return self.spilled_rows + len(self.current)
+
+    # Iterate over the log as a sequence of SignatureColumns, in order
+    def chunks(self):
+        if self.spilled_rows:
+            with open(self.spill_path, 'rb') as f:
+                rows = 0
+                while rows < self.spilled_rows:
+                    chunk = SignatureColumns.read(f)
+                    rows += len(chunk)
+                    yield chunk
+        yield self.current
+
+
 # Check how often blocks that are assigned particular probabilities of
-# finalization by our algorithm are actually finalized
-def calibrate(finalized_hashes):
+# finalization by our algorithm are actually finalized. Returns the bucket
+# thresholds and, per bucket, how many bets were on heights that ended up
+# finalized and discarded
+def calibration_counts(finalized_hashes, log):
     threshold_odds = [FINALITY_THRESHOLD ** (x * 0.1) for x in range(-10, 11)]
     thresholds = [x / (1 + x) for x in threshold_odds]
-    signed = [0] * (len(thresholds) - 1)
+    # A bet goes in the first bucket whose upper threshold it does not
+    # exceed. Taking the running maximum of the upper thresholds keeps
+    # that well-defined (and equal to a linear scan) whatever their
+    # order, and lets us find the bucket by bisection
+    bucket_tops = []
+    for t in thresholds[1:-1]:
+        bucket_tops.append(max(bucket_tops[-1], t) if bucket_tops else t)
     _finalized = [0] * (len(thresholds) - 1)
     _discarded = [0] * (len(thresholds) - 1)
-    for s, _ in all_signatures:
-        sf = s.sign_from
-        for i, prob in enumerate(s.probs):
-            if i + sf >= len(finalized_hashes):
-                continue
-            actual_result = 1 if finalized_hashes[i + sf] else 0
-            index = 0
-            while index + 2 < len(thresholds) and prob > thresholds[index + 1]:
-                index += 1
-            signed[index] += 1
-            if actual_result == 1:
-                _finalized[index] += 1
-            elif actual_result == 0:
-                _discarded[index] += 1
+    for columns in log.chunks():
+        probs, offsets, sign_froms = columns.probs, columns.offsets, columns.sign_from
+        for row in range(len(columns)):
+            start = offsets[row]
+            # Only look at the bets on heights that have been finalized
+            end = min(offsets[row + 1], start + len(finalized_hashes) - sign_froms[row])
+            for k in range(start, end):
+                index = bisect.bisect_left(bucket_tops, probs[k])
+                if finalized_hashes[sign_froms[row] + k - start]:
+                    _finalized[index] += 1
+                else:
+                    _discarded[index] += 1
+    return thresholds, _finalized, _discarded
+
+
+def calibrate(finalized_hashes, log):
+    thresholds, _finalized, _discarded = calibration_counts(finalized_hashes, log)
     for i in range(len(thresholds) - 1):
         if _finalized[i] + _discarded[i]:
             print 'Probability from %f to %f: %f (%d of %d)' % (thresholds[i], thresholds[i+1], _finalized[i] * 1.0 / (_finalized[i] + _discarded[i]), _finalized[i], _finalized[i] + _discarded[i])
     print 'Percentage of block heights filled: %f%%' % (len([x for x in finalized_hashes if x]) * 100.0 / len(finalized_hashes))
 
 
-def calc_rewards(finalized_hashes):
+def calc_rewards(finalized_hashes, log, verbose=True):
     most_recent = {}
     gains = {}
     losses = {}
     total_gains = {}
     total_losses = {}
-    for s, t in all_signatures:
-        if s.max_height >= len(finalized_hashes):
-            continue
-        prevsig, prevtime = most_recent.get(s.signer, (None, 0))
-        td = t - prevtime
-        if prevsig:
-            sf = s.sign_from
-            for i, p in enumerate(s.probs):
-                h = sf + i
-                oddspos, oddsneg = p / (1 - p), (1 - p) / p
-                if h < len(finalized_hashes):
+    for columns in log.chunks():
+        probs, offsets = columns.probs, columns.offsets
+        for row in range(len(columns)):
+            signer, sf = columns.signer[row], columns.sign_from[row]
+            start, end = offsets[row], offsets[row + 1]
+            # Skip signatures that reach beyond the finalized heights
+            if sf + end - start >= len(finalized_hashes):
+                continue
+            if signer in most_recent:
+                # Running totals of gains and losses by height for this signer
+                g, l = gains[signer], losses[signer]
+                for k in range(start, end):
+                    h = sf + k - start
+                    p = probs[k]
+                    oddspos, oddsneg = p / (1 - p), (1 - p) / p
                     if finalized_hashes[h] is False:
                         score_delta = oddsneg - oddspos * oddspos
                     else:
                         score_delta = oddspos - oddsneg * oddsneg
                     if score_delta >= 0:
-                        gains[s.signer][h] = (gains[s.signer][h-1] if h else 0) + score_delta
-                        losses[s.signer][h] = (losses[s.signer][h-1] if h else 0)
+                        g[h] = (g[h-1] if h else 0) + score_delta
+                        l[h] = (l[h-1] if h else 0)
                     else:
-                        if (p < 0.1 or p > 0.9) and s.signer:
-                            print s.signer, finalized_hashes[h] is not False, oddspos, oddsneg, score_delta
-                        gains[s.signer][h] = (gains[s.signer][h-1] if h else 0)
-                        losses[s.signer][h] = (losses[s.signer][h-1] if h else 0) - score_delta
-            # print 'Validator %d, total gains: %d total losses %d' % (s.signer, gains[h] - (gains[h-200] if h > 200 else 0), losses[h] - (losses[h-200] if h > 200 else 0))
-            total_gains[s.signer] += gains[s.signer][h] - (gains[s.signer][h-200] if h > 200 else 0)
-            total_losses[s.signer] += losses[s.signer][h] - (losses[s.signer][h-200] if h > 200 else 0)
-        else:
-            gains[s.signer], losses[s.signer] = [0] * 10000, [0] * 10000
-            total_gains[s.signer], total_losses[s.signer] = 0, 0
-        most_recent[s.signer] = s, t
+                        if verbose and (p < 0.1 or p > 0.9) and signer:
+                            print signer, finalized_hashes[h] is not False, oddspos, oddsneg, score_delta
+                        g[h] = (g[h-1] if h else 0)
+                        l[h] = (l[h-1] if h else 0) - score_delta
+                total_gains[signer] += g[h] - (g[h-200] if h > 200 else 0)
+                total_losses[signer] += l[h] - (l[h-200] if h > 200 else 0)
+            else:
+                gains[signer] = array('d', [0]) * len(finalized_hashes)
+                losses[signer] = array('d', [0]) * len(finalized_hashes)
+                total_gains[signer], total_losses[signer] = 0, 0
+            most_recent[signer] = True
     return total_gains, total_losses
 
-def run(steps=4000):
-    n = networksim.NetworkSimulator(latency=NETWORK_LATENCY)
-    for i in range(NUM_VALIDATORS):
-        if i == 0:
-            n.agents.append(Validator(i, n, vote=voting_strategy.craycray_vote))
-        elif i % 2:
-            n.agents.append(Validator(i, n, vote=voting_strategy.aggressive_vote))
-        else:
-            n.agents.append(Validator(i, n))
-    n.generate_peers(3)
-    while len(all_signatures):
-        all_signatures.pop()
-    for x in future.keys():
-        del future[x]
-    for x in finalized_blocks.keys():
-        del finalized_blocks[x]
-    for x in discarded.keys():
-        del discarded[x]
-    for i in range(steps):
-        n.tick()
-        if i % 500 == 0:
-            minmax = 99999999999999999
-            for x in n.agents:
-                minmax = min(minmax, x.max_finalized_height - 10)
-            print get_opinions(n)[max(minmax, 0):]
-            finalized0 = [(v.max_finalized_height, v.finalized_hashes) for v in n.agents]
-            if CHECK_INTEGRITY:
-                finalized = sorted(finalized0, key=lambda x: len(x[1]))
-                for j in range(len(n.agents) - 1):
-                    for k in range(len(finalized[j][1])):
-                        if finalized[j][1][k] is not None and finalized[j+1][1][k] is not None:
-                            if finalized[j][1][k] != finalized[j+1][1][k]:
-                                print finalized[j]
-                                print finalized[j+1]
-                                raise Exception("Finalization mismatch: %r %r" % (finalized[j][1][k], finalized[j+1][1][k]))
-            print 'Finalized status: %r' % [x[0] for x in finalized0]
-            _all = finalized0[0][1]
-            _pos = len([x for x in _all if x])
-            _neg = len([x for x in _all if not x])
-            print 'Finalized blocks: %r (%r positive, %r negative)' % (len(_all), _pos, _neg)
-        if i == 10000 and NETSPLITS >= 1:
-            print "###########################################################"
-            print "Knocking off 20% of the network!!!!!"
-            print "###########################################################"
-            n.knock_offline_random(NUM_VALIDATORS // 5)
-        if i == 20000 and NETSPLITS >= 2:
-            print "###########################################################"
-            print "Simluating a netsplit!!!!!"
-            print "###########################################################"
-            n.generate_peers()
-            n.partition()
-        if i == 30000 and NETSPLITS >= 1:
-            print "###########################################################"
-            print "Network health back to normal!"
-            print "###########################################################"
-            n.generate_peers()
-    calibrate(n.agents[0].finalized_hashes[:n.agents[0].max_finalized_height + 1])
-    gains, losses = calc_rewards(n.agents[0].finalized_hashes[:n.agents[0].max_finalized_height + 1])
+# A timed change to the network: at the given step, call each
+# (NetworkSimulator method name, args) in actions, in order
+class NetworkEvent():
+    def __init__(self, step, actions, description=None):
+        self.step = step
+        self.actions = actions
+        self.description = description
+
+
+# The schedule of network events selected by the NETSPLITS setting
+def netsplit_scenario(netsplits):
+    o = []
+    if netsplits >= 1:
+        o.append(NetworkEvent(10000, [('knock_offline_random', (NUM_VALIDATORS // 5,))],
+                              "Knocking off 20% of the network!!!!!"))
+    if netsplits >= 2:
+        o.append(NetworkEvent(20000, [('generate_peers', ()), ('partition', ())],
+                              "Simluating a netsplit!!!!!"))
+    if netsplits >= 1:
+        o.append(NetworkEvent(30000, [('generate_peers', ())],
+                              "Network health back to normal!"))
+    return o
+
+
+# Checks that validators never finalize conflicting blocks. Keeps the one
+# finalized chain seen so far, as a dict of height -> block hash (or False
+# for an empty height), and the height up to which each validator's
+# contiguous finalized prefix has been checked, so that prefix is looked
+# at only once as it grows. Heights finalized above a gap in the prefix
+# are checked on every check until the prefix reaches them, so a
+# conflict anywhere raises at the first check that can see it
+class FinalityChecker():
+    def __init__(self):
+        self.finalized = {}
+        self.checked_up_to = {}
+
+    def check(self, validators):
+        for v in validators:
+            for h in range(self.checked_up_to.get(v.id, -1) + 1, v.max_finalized_height + 1):
+                self.check_height(v, h)
+            self.checked_up_to[v.id] = max(self.checked_up_to.get(v.id, -1), v.max_finalized_height)
+            for h in range(self.checked_up_to[v.id] + 1, len(v.finalized_hashes)):
+                if v.finalized_hashes[h] is not None:
+                    self.check_height(v, h)
+
+    def check_height(self, v, h):
+        if h not in self.finalized:
+            self.finalized[h] = v.finalized_hashes[h]
+        elif self.finalized[h] != v.finalized_hashes[h]:
+            raise Exception("Finalization mismatch at height %d: %r %r (validator %d)" %
+                            (h, self.finalized[h], v.finalized_hashes[h], v.id))
+
+
+# A single simulation: the network, its validators and the log of every
+# signature they make. All state lives here, so that any number of
+# simulations can be run side by side, and snapshotted and forked.
+class Simulation():
+    def __init__(self, spill_path=None, scenario=None):
+        self.signature_log = SignatureLog(spill_path)
+        self.network = n = networksim.NetworkSimulator(latency=NETWORK_LATENCY, batched=BATCHED_SAMPLING)
+        self.state_cache = StateCache()
+        for i in range(NUM_VALIDATORS):
+            if i == 0:
+                n.add_agent(Validator(i, n, vote=voting_strategy.craycray_vote, signature_log=self.signature_log, state_cache=self.state_cache))
+            elif i % 2:
+                n.add_agent(Validator(i, n, vote=voting_strategy.aggressive_vote, signature_log=self.signature_log, state_cache=self.state_cache))
+            else:
+                n.add_agent(Validator(i, n, signature_log=self.signature_log, state_cache=self.state_cache))
+        n.generate_peers(3)
+        # The network events to apply, as a list of NetworkEvents
+        self.scenario = netsplit_scenario(NETSPLITS) if scenario is None else scenario
+        self.finality_checker = FinalityChecker()
+
+    # Run for the given number of steps, from wherever the simulation is now
+    def run(self, steps, verbose=True):
+        n = self.network
+        start, end = n.time, n.time + steps
+        events = {}
+        for e in self.scenario:
+            if start <= e.step < end:
+                events.setdefault(e.step, []).append(e)
+        # Steps after which we report or change the network; the simulator
+        # skips straight over everything in between
+        checkpoints = set(range(start + (-start) % 500, end, 500)) | set(events)
+        for i in sorted(checkpoints):
+            n.run(i + 1 - n.time)
+            if i % 500 == 0:
+                finalized0 = [(v.max_finalized_height, v.finalized_hashes) for v in n.agents]
+                if verbose:
+                    minmax = 99999999999999999
+                    for x in n.agents:
+                        minmax = min(minmax, x.max_finalized_height - 10)
+                    print get_opinions(n)[max(minmax, 0):]
+                if CHECK_INTEGRITY:
+                    self.finality_checker.check(n.agents)
+                if verbose:
+                    print 'Finalized status: %r' % [x[0] for x in finalized0]
+                    _all = finalized0[0][1]
+                    _pos = len([x for x in _all if x])
+                    _neg = len([x for x in _all if not x])
+                    print 'Finalized blocks: %r (%r positive, %r negative)' % (len(_all), _pos, _neg)
+            for e in events.get(i, []):
+                if verbose and e.description:
+                    print "###########################################################"
+                    print e.description
+                    print "###########################################################"
+                for method, args in e.actions:
+                    getattr(n, method)(*args)
+        n.run(end - n.time)
+
+    # The chain as finalized by the first validator
+    def finalized_hashes(self):
+        v = self.network.agents[0]
+        return v.finalized_hashes[:v.max_finalized_height + 1]
+
+    # Capture the whole state of the simulation, including the random
+    # number generator, so that several branches can be run from here
+    def snapshot(self):
+        return copy.deepcopy((self, random.getstate()))
+
+
+# Restore a snapshot as a new, independent simulation (and reset the
+# random number generator to where it was). A simulation that spills its
+# signature log to disk must be given a file of its own to continue in;
+# it starts with the part of the parent's file written before the
+# snapshot, whatever the parent has spilled since.
+def fork(snapshot, spill_path=None):
+    sim, rng_state = copy.deepcopy(snapshot)
+    log = sim.signature_log
+    if log.spill_path:
+        assert spill_path and spill_path != log.spill_path, "fork needs its own spill file"
+        with open(log.spill_path, 'rb') as src:
+            with open(spill_path, 'wb') as dst:
+                remaining = log.spilled_bytes
+                while remaining:
+                    data = src.read(min(remaining, 1 << 20))
+                    assert data, "spill file shorter than at snapshot"
+                    dst.write(data)
+                    remaining -= len(data)
+        log.spill_path = spill_path
+    random.setstate(rng_state)
+    return sim
+
+
+def run(steps=4000, spill_path=None):
+    sim = Simulation(spill_path)
+    sim.run(steps)
+    calibrate(sim.finalized_hashes(), sim.signature_log)
+    gains, losses = calc_rewards(sim.finalized_hashes(), sim.signature_log)
     for (k, g), (_, l) in zip(gains.items(), losses.items()):
         print 'Agent %d got a total reward of %d with %d gains and %d losses' % (k, g - l, g, l)
+    return sim
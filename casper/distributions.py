@@ -1,4 +1,4 @@
-import random, sys
+import random, sys, math
 
 
 def normal_distribution(mean, standev):
@@ -35,3 +35,52 @@ def transform(dist, xformer):
         return xformer(dist())
 
     return f
+
+
+
+# Batched versions of the above. A batched sampler draws its samples
+# block_size at a time from a random.Random stream of its own, and hands
+# them out one at a time or n at a time with take(n), so drawing a sample
+# costs no chain of closure calls. Each stream is seeded from the random
+# module when the sampler is made, so seeding the random module still
+# makes runs reproducible.
+class BatchedSampler():
+    def __init__(self, draw, block_size=4096):
+        self.rng = random.Random(random.getrandbits(64))
+        # Function of (rng, n) returning a list of n samples
+        self.draw = draw
+        self.block_size = block_size
+        self.buffer = []
+
+    def __call__(self):
+        if not self.buffer:
+            self.buffer = self.draw(self.rng, self.block_size)
+        return self.buffer.pop()
+
+    def take(self, n):
+        while len(self.buffer) < n:
+            self.buffer = self.draw(self.rng, self.block_size) + self.buffer
+        o = self.buffer[-n:] if n else []
+        del self.buffer[len(self.buffer) - n:]
+        return o
+
+
+def batched_normal_distribution(mean, standev, block_size=4096):
+    # Box-Muller transform, which gives two samples per pair of uniforms
+    def draw(rng, n):
+        o = []
+        for i in range((n + 1) // 2):
+            r = standev * math.sqrt(-2.0 * math.log(1.0 - rng.random()))
+            theta = 2 * math.pi * rng.random()
+            o.append(int(mean + r * math.cos(theta)))
+            o.append(int(mean + r * math.sin(theta)))
+        return o[:n]
+
+    return BatchedSampler(draw, block_size)
+
+
+def batched_transform(sampler, xformer):
+    def draw(rng, n):
+        return map(xformer, sampler.draw(rng, n))
+
+    return BatchedSampler(draw, sampler.block_size)
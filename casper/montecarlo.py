@@ -0,0 +1,84 @@
+import math
+import multiprocessing
+import random
+import sys
+import casper
+
+# Runs many independent replicas of the simulation in a process pool and
+# aggregates their finality calibration and per-agent rewards.
+#
+# Every replica reseeds the random module with its own seed before it
+# starts, so the results of replica i depend only on (base_seed, i), not
+# on which worker runs it or in what order.
+#
+# Usage: python montecarlo.py [replicas] [steps] [base_seed] [processes]
+
+
+def replica_seed(base_seed, i):
+    return base_seed * 1000003 + i
+
+
+# Run one replica; returns its calibration counts and rewards
+def run_replica(args):
+    seed, steps = args
+    random.seed(seed)
+    sim = casper.Simulation()
+    sim.run(steps, verbose=False)
+    finalized_hashes = sim.finalized_hashes()
+    thresholds, finalized, discarded = casper.calibration_counts(finalized_hashes, sim.signature_log)
+    gains, losses = casper.calc_rewards(finalized_hashes, sim.signature_log, verbose=False)
+    return {
+        "seed": seed,
+        "thresholds": thresholds,
+        "finalized": finalized,
+        "discarded": discarded,
+        "rewards": {k: gains[k] - losses[k] for k in gains},
+    }
+
+
+def run_replicas(replicas, steps, base_seed=0, processes=None):
+    jobs = [(replica_seed(base_seed, i), steps) for i in range(replicas)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(run_replica, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Pool the calibration buckets across replicas. Returns a list of
+# (low, high, finalized, total, fraction, 95% confidence half-width)
+def aggregate_calibration(results):
+    thresholds = results[0]["thresholds"]
+    o = []
+    for i in range(len(thresholds) - 1):
+        finalized = sum([r["finalized"][i] for r in results])
+        total = finalized + sum([r["discarded"][i] for r in results])
+        if total:
+            p = finalized * 1.0 / total
+            o.append((thresholds[i], thresholds[i+1], finalized, total, p, 1.96 * math.sqrt(p * (1 - p) / total)))
+    return o
+
+
+# Mean and standard error of each agent's total reward across replicas
+def aggregate_rewards(results):
+    o = {}
+    for agent in sorted(results[0]["rewards"]):
+        values = [r["rewards"][agent] for r in results if agent in r["rewards"]]
+        mean = sum(values) * 1.0 / len(values)
+        var = sum([(v - mean) ** 2 for v in values]) / max(len(values) - 1, 1)
+        o[agent] = (mean, math.sqrt(var / len(values)))
+    return o
+
+
+if __name__ == '__main__':
+    replicas = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    base_seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    results = run_replicas(replicas, steps, base_seed, processes)
+    print 'Ran %d replicas of %d steps' % (replicas, steps)
+    for low, high, finalized, total, p, ci in aggregate_calibration(results):
+        print 'Probability from %f to %f: %f +/- %f (%d of %d)' % (low, high, p, ci, finalized, total)
+    for agent, (mean, stderr) in sorted(aggregate_rewards(results).items()):
+        print 'Agent %d got a mean total reward of %d +/- %d' % (agent, mean, 1.96 * stderr)
@@ -1,16 +1,57 @@
-from distributions import transform, normal_distribution
+from distributions import transform, normal_distribution, batched_transform, \
+    batched_normal_distribution
 import random
+import heapq
 
 
+# The simulator is event-driven: rather than ticking every agent on every
+# time step, it keeps a heap of the times at which messages are due and a
+# heap of agent wakeup times, and jumps straight to the next of either.
+# Agents opt in by implementing next_wakeup(), which returns the network
+# time at which their tick() next does anything; agents without it are
+# ticked on every step, as are all agents if event_driven is False.
 class NetworkSimulator():
 
-    def __init__(self, latency=50):
+    def __init__(self, latency=50, event_driven=True, batched=False):
         self.agents = []
-        self.latency_distribution_sample = transform(normal_distribution(latency, (latency * 2) // 5), lambda x: max(x, 0))
+        # With batched=True, latencies are drawn a block at a time and
+        # delivery failures from a stream of the network's own, instead of
+        # one draw at a time from the random module
+        self.batched = batched
+        if batched:
+            self.latency_distribution_sample = batched_transform(batched_normal_distribution(latency, (latency * 2) // 5), lambda x: max(x, 0))
+            self.rng = random.Random(random.getrandbits(64))
+        else:
+            self.latency_distribution_sample = transform(normal_distribution(latency, (latency * 2) // 5), lambda x: max(x, 0))
+            self.rng = None
         self.time = 0
         self.objqueue = {}
+        # Heap of times that have an entry in objqueue
+        self.objqueue_times = []
         self.peers = {}
         self.reliability = 0.9
+        self.event_driven = event_driven
+        # Heap of (wakeup time, agent index), and the agent list it was
+        # built from
+        self.wakeups = []
+        self.scheduled_agents = None
+        # Map from agent ID to agent, and the agent list it was built from
+        self.agents_by_id = {}
+        self.registered_agents = None
+
+    def add_agent(self, agent):
+        self.agents.append(agent)
+        self.agents_by_id[agent.id] = agent
+
+    # Rebuild the ID registry if the agent list was changed behind our back
+    def sync_agents(self):
+        if self.registered_agents is not self.agents or len(self.agents_by_id) != len(self.agents):
+            self.agents_by_id = {a.id: a for a in self.agents}
+            self.registered_agents = self.agents
+
+    def get_agent(self, agent_id):
+        self.sync_agents()
+        return self.agents_by_id.get(agent_id, None)
 
     def generate_peers(self, num_peers=5):
         self.peers = {}
@@ -20,38 +61,86 @@ class NetworkSimulator():
                 p.append(random.choice(self.agents))
                 if p[-1] == a:
                     p.pop()
-            self.peers[a.id] = self.peers.get(a.id, []) + p
+            self.peers.setdefault(a.id, []).extend(p)
             for peer in p:
-                self.peers[peer.id] = self.peers.get(peer.id, []) + [a]
+                self.peers.setdefault(peer.id, []).append(a)
 
-    def tick(self):
+    # Is every agent able to tell us when it next needs to be ticked?
+    def can_schedule(self):
+        if not self.event_driven:
+            return False
+        if self.scheduled_agents is not self.agents or len(self.wakeups) != len(self.agents):
+            if not all(hasattr(a, 'next_wakeup') for a in self.agents):
+                return False
+            self.wakeups = [(a.next_wakeup(), i) for i, a in enumerate(self.agents)]
+            heapq.heapify(self.wakeups)
+            self.scheduled_agents = self.agents
+        return True
+
+    # Deliver the messages due at the current time, then tick the agents
+    def process(self, scheduled):
         if self.time in self.objqueue:
             for recipient, obj in self.objqueue[self.time]:
-                if random.random() < self.reliability:
+                if (self.rng.random() if self.batched else random.random()) < self.reliability:
                     recipient.on_receive(obj)
             del self.objqueue[self.time]
-        for a in self.agents:
-            a.tick()
+        while self.objqueue_times and self.objqueue_times[0] <= self.time:
+            heapq.heappop(self.objqueue_times)
+        if not scheduled:
+            for a in self.agents:
+                a.tick()
+            return
+        # Only tick agents that are due, in the same order as the agent list
+        due = []
+        while self.wakeups and self.wakeups[0][0] <= self.time:
+            due.append(heapq.heappop(self.wakeups)[1])
+        for i in sorted(due):
+            self.agents[i].tick()
+            heapq.heappush(self.wakeups, (max(self.agents[i].next_wakeup(), self.time + 1), i))
+
+    def tick(self):
+        self.process(self.can_schedule())
         self.time += 1
 
     def run(self, steps):
-        for i in range(steps):
-            self.tick()
+        end_time = self.time + steps
+        while self.time < end_time:
+            if not self.can_schedule():
+                self.tick()
+                continue
+            # Jump to the next delivery or agent wakeup
+            next_time = end_time
+            if self.wakeups:
+                next_time = min(next_time, self.wakeups[0][0])
+            if self.objqueue_times:
+                next_time = min(next_time, self.objqueue_times[0])
+            if next_time >= end_time:
+                break
+            self.time = max(self.time, next_time)
+            self.process(True)
+            self.time += 1
+        self.time = max(self.time, end_time)
+
+    def enqueue(self, recv_time, recipient, obj):
+        if recv_time not in self.objqueue:
+            self.objqueue[recv_time] = []
+            heapq.heappush(self.objqueue_times, recv_time)
+        self.objqueue[recv_time].append((recipient, obj))
 
     def broadcast(self, sender, obj):
-        for p in self.peers[sender.id]:
-            recv_time = self.time + self.latency_distribution_sample()
-            if recv_time not in self.objqueue:
-                self.objqueue[recv_time] = []
-            self.objqueue[recv_time].append((p, obj))
+        peers = self.peers[sender.id]
+        if self.batched:
+            latencies = self.latency_distribution_sample.take(len(peers))
+        else:
+            latencies = [self.latency_distribution_sample() for p in peers]
+        for p, latency in zip(peers, latencies):
+            self.enqueue(self.time + latency, p, obj)
 
     def direct_send(self, to_id, obj):
-        for a in self.agents:
-            if a.id == to_id:
-                recv_time = self.time + self.latency_distribution_sample()
-                if recv_time not in self.objqueue:
-                    self.objqueue[recv_time] = []
-                self.objqueue[recv_time].append((a, obj))
+        a = self.get_agent(to_id)
+        if a is not None:
+            recv_time = self.time + self.latency_distribution_sample()
+            self.enqueue(recv_time, a, obj)
 
     def knock_offline_random(self, n):
         ko = {}
@@ -2,4 +2,5 @@ import casper
 import sys
 
 casper.logging_level = int(sys.argv[1]) if len(sys.argv) > 1 else 0
-casper.run(50000)
+# Optionally spill the signature log to this file as the run goes
+casper.run(50000, spill_path=sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,33 @@
+import casper
+
+
+# Just the parts of a validator that the finality checker reads
+class FinalizedView():
+    def __init__(self, id, finalized_hashes):
+        self.id = id
+        self.finalized_hashes = finalized_hashes
+        self.max_finalized_height = -1
+        while self.max_finalized_height < len(finalized_hashes) - 1 \
+                and finalized_hashes[self.max_finalized_height + 1] is not None:
+            self.max_finalized_height += 1
+
+# Agreeing validators pass, including on heights above a gap
+checker = casper.FinalityChecker()
+checker.check([FinalizedView(0, [1, 2, None, 4]), FinalizedView(1, [1, None, None, 4])])
+checker.check([FinalizedView(0, [1, 2, 3, 4, 5]), FinalizedView(1, [1, 2, 3, 4])])
+
+print 'Agreeing finalized chains passed'
+
+# A conflicting block finalized above a gap in a validator's finalized
+# prefix raises at the first check, without waiting for the gap to fill
+checker = casper.FinalityChecker()
+checker.check([FinalizedView(0, [1, 2, 3])])
+raised = False
+try:
+    checker.check([FinalizedView(0, [1, 2, 3]), FinalizedView(1, [1, None, False])])
+except Exception as e:
+    assert 'Finalization mismatch at height 2' in str(e), e
+    raised = True
+assert raised, "Conflict above a gap not caught"
+
+print 'Conflict above a gap passed'
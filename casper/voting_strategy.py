@@ -1,5 +1,6 @@
 import random
 import math
+import bisect
 
 # The voting strategy. Validators see what every other validator votes,
 # and return their vote.
@@ -8,20 +9,47 @@ import math
 # http://lesswrong.com/lw/mp/0_and_1_are_not_probabilities/ !)
 
 def default_vote(scheduled_time, received_time, now, **kwargs):
+    rand = kwargs.get("rand", random.random)
     if received_time is None:
         time_delta = now - scheduled_time
         my_opinion_prob = 1 if time_delta < kwargs["blktime"] * 4 else 4.0 / (4 + time_delta * 1.0 / kwargs["blktime"])
-        return 0.5 if random.random() < my_opinion_prob else 0.3
+        return 0.5 if rand() < my_opinion_prob else 0.3
     else:
         time_delta = received_time * 0.98 + now * 0.02 - scheduled_time
         my_opinion_prob = 1 if abs(time_delta) < kwargs["blktime"] * 4 else 4.0 / (4 + abs(time_delta) * 1.0 / kwargs["blktime"])
-        return 0.7 if random.random() < my_opinion_prob else 0.3
+        return 0.7 if rand() < my_opinion_prob else 0.3
     
 
+# Read-only sorted view over a sorted list of bets plus enough copies of a
+# default bet to make up `total` entries. Indexing is O(1), so strategies
+# can read quantiles off it without building and sorting a padded list.
+class PaddedVotes():
+    def __init__(self, sorted_votes, default, total):
+        self.sorted_votes = sorted_votes
+        self.default = default
+        self.padding = max(total - len(sorted_votes), 0)
+        self.default_pos = bisect.bisect_left(sorted_votes, default)
+
+    def __len__(self):
+        return len(self.sorted_votes) + self.padding
+
+    def __getitem__(self, k):
+        if k < self.default_pos:
+            return self.sorted_votes[k]
+        elif k < self.default_pos + self.padding:
+            return self.default
+        else:
+            return self.sorted_votes[k - self.padding]
+
+
+def sort_votes(probs):
+    return probs if isinstance(probs, PaddedVotes) else sorted(probs)
+
+
 def vote(probs):
     if len(probs) == 0:
         return 0.5
-    probs = sorted(probs)
+    probs = sort_votes(probs)
     if probs[len(probs)/3] >= 0.7:
         return 0.84 + probs[len(probs)/3] * 0.16
     elif probs[len(probs)*2/3] <= 0.3:
@@ -34,7 +62,7 @@ FINALITY_THRESHOLD = 0.000001
 def aggressive_vote(probs):
     if len(probs) == 0:
         return 0.5
-    probs = sorted(probs)
+    probs = sort_votes(probs)
     if probs[len(probs)/3] >= 0.9:
         return 1 - FINALITY_THRESHOLD
     elif probs[len(probs)*2/3] <= 0.1:
@@ -49,7 +77,7 @@ def aggressive_vote(probs):
 def craycray_vote(probs):
     if len(probs) == 0:
         return 0.5
-    probs = sorted(probs)
+    probs = sort_votes(probs)
     if probs[len(probs)/3] >= 1 - FINALITY_THRESHOLD:
         return 1 - FINALITY_THRESHOLD
     elif probs[len(probs)*2/3] <= FINALITY_THRESHOLD:
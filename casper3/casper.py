@@ -6,11 +6,17 @@ from ethereum.utils import sha3, hash32, privtoaddr, ecsign, zpad, encode_int32,
 from ethereum.block import Block
 from ethereum.transactions import Transaction
 from ethereum.chain import Chain
+from ethereum.db import EphemDB
 import networksim
 import rlp
 import random
+from collections import OrderedDict
 
 CHECK_FOR_UNCLES_BACK = 8
+# Number of Casper contract call results to remember
+CALL_CACHE_SIZE = 8192
+# Number of applied blocks' post-state roots to remember
+APPLIED_BLOCKS_SIZE = 4096
 
 global_block_counter = 0
 
@@ -28,12 +34,158 @@ class ChildRequest(rlp.Serializable):
     def hash(self):
         return sha3(self.prevhash + '::salt:jhfqou213nry138o2r124124')
 
+# Memo of Casper contract calls. A call's result depends only on the
+# state it is made against, so results are keyed by the committed state
+# root and the block fields the EVM exposes, along with the call itself.
+# (Block hashes are kept in the state under Casper, so the root covers
+# them.) Calls against a state with uncommitted changes, which the root
+# doesn't reflect, aren't memoized. Shared by all validators, as they
+# mostly sit on the same heads. Least recently used results are dropped
+# first.
+class CallCache():
+    def __init__(self, size=CALL_CACHE_SIZE):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def call(self, state, fun, args=[]):
+        if state.modified:
+            return call_casper(state, fun, args)
+        key = (state.trie.root_hash, state.block_number, state.timestamp, state.block_coinbase,
+               state.block_difficulty, state.gas_limit, fun, tuple(args))
+        if key in self.results:
+            self.hits += 1
+            result = self.results.pop(key)
+        else:
+            self.misses += 1
+            result = call_casper(state, fun, args)
+            if len(self.results) >= self.size:
+                self.results.popitem(last=False)
+        self.results[key] = result
+        return result
+
+casper_call_cache = CallCache()
+
+
+# A validator's database, backed by a store shared with every other
+# validator in the process. Content-addressed values (trie nodes and
+# code, whose key is their own hash) go to the shared store, so each is
+# kept once. Everything else, including blocks and the chain's head,
+# index and fork choice records, stays private to the validator, so each
+# validator still only sees the blocks it has received itself.
+class SharedDB(EphemDB):
+    def __init__(self, shared):
+        EphemDB.__init__(self)
+        self.shared = shared
+
+    def get(self, key):
+        if key in self.db:
+            return self.db[key]
+        return self.shared[key]
+
+    def put(self, key, value):
+        # Content-addressed values never change, so one that is already
+        # shared needn't be hashed or stored again
+        if key in self.shared:
+            return
+        if len(key) == 32 and sha3(value) == key:
+            self.shared[key] = value
+        else:
+            self.db[key] = value
+
+    def delete(self, key):
+        # Other validators may still need shared values
+        if key in self.db:
+            del self.db[key]
+
+    def _has_key(self, key):
+        return key in self.db or key in self.shared
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+
+# Post-state roots of blocks that validators have applied, keyed by the
+# state root each block was applied to and the block's hash. Shared by
+# the validators' SharedChains, so that each block is executed once
+# rather than by every validator. Least recently used roots are dropped
+# first.
+class AppliedBlocks():
+    def __init__(self, size=APPLIED_BLOCKS_SIZE):
+        self.size = size
+        self.roots = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pre_root, block):
+        key = (pre_root, block.header.hash)
+        if key not in self.roots:
+            self.misses += 1
+            return None
+        self.hits += 1
+        post_root = self.roots.pop(key)
+        self.roots[key] = post_root
+        return post_root
+
+    def put(self, pre_root, block, post_root):
+        key = (pre_root, block.header.hash)
+        if key not in self.roots and len(self.roots) >= self.size:
+            self.roots.popitem(last=False)
+        self.roots[key] = post_root
+
+
+# A chain that shares block execution with other validators' chains. A
+# block extending the head, which another validator has already applied
+# to the same state, is added without executing it: its post-state is
+# rebuilt from the recorded root, the same way the chain rebuilds the
+# post-state of any block it has stored. Every other block goes through
+# Chain.add_block, and any block that applies to the head is recorded
+# for the others. Needs a SharedDB, so that the recorded post-state's
+# trie can be read.
+class SharedChain(Chain):
+    def __init__(self, genesis, applied_blocks, env=None):
+        Chain.__init__(self, genesis, env=env)
+        self.applied_blocks = applied_blocks
+
+    def add_block(self, block):
+        # Blocks that are early, off the head, or on a state with
+        # uncommitted changes go the usual way
+        if block.header.prevhash != self.head_hash or block.header.timestamp > self.time() \
+                or self.state.modified:
+            return Chain.add_block(self, block)
+        pre_root = self.state.trie.root_hash
+        post_root = self.applied_blocks.get(pre_root, block)
+        if post_root is None or post_root not in self.db:
+            success = Chain.add_block(self, block)
+            if success and self.head_hash == block.header.hash:
+                self.applied_blocks.put(pre_root, block, self.state.trie.root_hash)
+            return success
+        # The records Chain.add_block makes for a block applied to the head
+        self.db.put(block.header.hash, rlp.encode(block))
+        self.db.put('state:' + block.header.hash, post_root)
+        self.state = self.mk_poststate_of_blockhash(block.header.hash)
+        self.db.put('block:' + str(block.header.number), block.header.hash)
+        self.head_hash = block.header.hash
+        for i, tx in enumerate(block.transactions):
+            self.db.put('txindex:' + tx.hash, rlp.encode([block.number, i]))
+        self.add_child(block)
+        self.db.put('head_hash', self.head_hash)
+        self.db.commit()
+        if self.new_head_cb and block.header.number != 0:
+            self.new_head_cb(block)
+        return True
+
 ids = []
 
 class Validator():
-    def __init__(self, genesis, key, network, env, time_offset=5):
-        # Create a chain object
-        self.chain = Chain(genesis, env=env)
+    def __init__(self, genesis, key, network, env, time_offset=5, applied_blocks=None):
+        # Create a chain object, sharing block execution with other
+        # validators if given an AppliedBlocks record to share
+        if applied_blocks is not None:
+            self.chain = SharedChain(genesis, applied_blocks, env=env)
+        else:
+            self.chain = Chain(genesis, env=env)
         # Use the validator's time as the chain's time
         self.chain.time = lambda: self.get_timestamp()
         # My private key
@@ -55,6 +207,14 @@ class Validator():
         self.active = False
         # Code that verifies signatures from this validator
         self.validation_code = generate_validation_code(privtoaddr(key))
+        # Map from validation code to the (validator size, index) slots
+        # registered with it, and how many slots of each size have been
+        # read into it so far, and the (number, hash) of the head they were
+        # read at. Slots are only ever appended, so each one only needs to
+        # be read once while the chain still runs through that head
+        self.valcode_indices = {}
+        self.valcodes_read = [0] * len(validator_sizes)
+        self.valcodes_head = None
         # Parents that this validator has already built a block on
         self.used_parents = {}
         # This validator's clock offset (for testing purposes)
@@ -68,33 +228,46 @@ class Validator():
         self.cached_head = self.chain.head_hash
 
     def call_casper(self, fun, args=[]):
-        return call_casper(self.chain.state, fun, args)
+        return casper_call_cache.call(self.chain.state, fun, args)
 
     def find_my_indices(self):
         epoch = self.chain.state.block_number // self.epoch_length
         print 'Finding indices for epoch %d' % epoch, self.call_casper('getEpoch')
+        # After a reorg away from the head the slots were read at, the new
+        # chain's slots may hold other validation codes, so read them again
+        if self.valcodes_head is not None:
+            number, blockhash = self.valcodes_head
+            if number > self.chain.state.block_number or \
+                    (number > 0 and self.chain.get_blockhash_by_number(number) != blockhash):
+                self.valcode_indices = {}
+                self.valcodes_read = [0] * len(validator_sizes)
+        self.valcodes_head = (self.chain.state.block_number, self.chain.head_hash)
+        valcounts = []
         for i in range(len(validator_sizes)):
             valcount = self.call_casper('getHistoricalValidatorCount', [epoch, i])
             print i, valcount, self.call_casper('getHistoricalValidatorCount', [0, i])
-            for j in range(valcount):
+            for j in range(self.valcodes_read[i], valcount):
                 valcode = self.call_casper('getValidationCode', [i, j])
-                print (valcode, self.validation_code)
-                if valcode == self.validation_code:
-                    self.indices = i, j
-                    start = self.call_casper('getStartEpoch', [i, j])
-                    end = self.call_casper('getEndEpoch', [i, j])
-                    if start <= epoch < end:
-                        self.active = True
-                        self.next_skip_count = 0
-                        self.next_skip_timestamp = get_timestamp(self.chain, self.next_skip_count)
-                        print 'In current validator set at (%d, %d)' % (i, j)
-                        return
-                    else:
-                        self.indices = None
-                        self.active = False
-                        self.next_skip_count, self.next_skip_timestamp = 0, 0
-                        print 'Registered at (%d, %d) but not in current set' % (i, j)
-                        return
+                self.valcode_indices.setdefault(valcode, []).append((i, j))
+            self.valcodes_read[i] = max(self.valcodes_read[i], valcount)
+            valcounts.append(valcount)
+        for i, j in sorted(self.valcode_indices.get(self.validation_code, [])):
+            if j < valcounts[i]:
+                self.indices = i, j
+                start = self.call_casper('getStartEpoch', [i, j])
+                end = self.call_casper('getEndEpoch', [i, j])
+                if start <= epoch < end:
+                    self.active = True
+                    self.next_skip_count = 0
+                    self.next_skip_timestamp = get_timestamp(self.chain, self.next_skip_count)
+                    print 'In current validator set at (%d, %d)' % (i, j)
+                    return
+                else:
+                    self.indices = None
+                    self.active = False
+                    self.next_skip_count, self.next_skip_timestamp = 0, 0
+                    print 'Registered at (%d, %d) but not in current set' % (i, j)
+                    return
         self.indices = None
         self.active = False
         self.next_skip_count, self.next_skip_timestamp = 0, 0
@@ -107,12 +280,43 @@ class Validator():
         else:
             descendants = self.chain.get_descendants(self.chain.db.get('GENESIS_HASH'))
         potential_uncles = [x for x in descendants if x not in self.chain and isinstance(x, Block)]
-        uncles = [x.header for x in potential_uncles if not call_casper(self.chain.state, 'isDunkleIncluded', [x.header.hash])]
+        uncles = [x.header for x in potential_uncles if not self.call_casper('isDunkleIncluded', [x.header.hash])]
         return uncles
 
     def get_timestamp(self):
         return int(self.network.time * 0.01) + self.time_offset
 
+    # The first network time at which get_timestamp() reaches a timestamp
+    def network_time_at(self, timestamp):
+        return (timestamp - self.time_offset) * 100
+
+    # Are any blocks waiting on a parent that we now have?
+    def parent_queue_ready(self):
+        return any(h in self.chain.db for h in self.chain.parent_queue)
+
+    # Apply blocks whose parents we now have. Applying one can let
+    # through blocks queued on it in turn, so keep going until none are
+    # ready
+    def process_parent_queue(self):
+        while self.parent_queue_ready():
+            self.chain.process_parent_queue()
+
+    # The network time at which tick() next has something to do: make a
+    # block once our clock reaches the next skip timestamp, apply blocks
+    # that arrived before our clock reached their timestamps, or apply
+    # blocks whose parents have since been added
+    def next_wakeup(self):
+        if self.parent_queue_ready():
+            return self.network.time
+        t = float('inf')
+        if self.indices and self.chain.head_hash not in self.used_parents:
+            t = self.next_skip_timestamp
+            if self.chain.head:
+                t = max(t, self.chain.head.header.timestamp + 1)
+        if self.chain.time_queue:
+            t = min(t, self.chain.time_queue[0].header.timestamp)
+        return self.network_time_at(t) if t != float('inf') else t
+
     def on_receive(self, obj):
         if isinstance(obj, list):
             for _obj in obj:
@@ -124,6 +328,9 @@ class Validator():
             print 'Receiving block', obj
             assert obj.hash not in self.chain
             block_success = self.chain.add_block(obj)
+            # Apply any blocks that arrived before this, their parent
+            if block_success:
+                self.process_parent_queue()
             self.network.broadcast(self, obj)
             self.network.broadcast(self, ChildRequest(obj.header.hash))
             self.update_head()
@@ -135,6 +342,13 @@ class Validator():
             assert x.hash in self.received_objects
 
     def tick(self):
+        # Apply blocks that we received too early, once our clock has
+        # reached their timestamps, and then any of their children that
+        # arrived before them
+        if self.chain.time_queue and self.chain.time_queue[0].header.timestamp <= self.get_timestamp():
+            self.chain.process_time_queue()
+        self.process_parent_queue()
+        self.update_head()
         # Try to create a block
         # Conditions:
         # (i) you are an active validator,
@@ -156,7 +370,7 @@ class Validator():
                     print 'Simulating validator failure, block %d not created' % (self.chain.head.header.number + 1 if self.chain.head else 0)
                     return
                 # Make the block, make sure it's valid
-                pre_dunkle_count = call_casper(self.chain.state, 'getTotalDunklesIncluded', [])
+                pre_dunkle_count = self.call_casper('getTotalDunklesIncluded')
                 dunkle_txs = []
                 for i, u in enumerate(self.get_uncles()[:4]):
                     start_nonce = self.chain.state.get_nonce(self.address)
@@ -173,18 +387,11 @@ class Validator():
                 assert blk.timestamp >= self.next_skip_timestamp
                 assert self.chain.add_block(blk)
                 self.update_head()
-                post_dunkle_count = call_casper(self.chain.state, 'getTotalDunklesIncluded', [])
+                post_dunkle_count = self.call_casper('getTotalDunklesIncluded')
                 assert post_dunkle_count - pre_dunkle_count == len(dunkle_txs)
                 self.received_objects[blk.hash] = True
                 print 'Validator %d making block %d (%s)' % (self.id, blk.header.number, blk.header.hash[:8].encode('hex'))
                 self.network.broadcast(self, blk)
-        # Sometimes we received blocks too early or out of order;
-        # run an occasional loop that processes these
-        if random.random() < 0.02:
-            self.chain.process_time_queue()
-            self.chain.process_parent_queue()
-            self.update_head()
-
     def update_head(self):
         if self.cached_head == self.chain.head_hash:
             return
@@ -1,16 +1,35 @@
 from distributions import transform, normal_distribution
 import random
+import heapq
 
 
+# The simulator is event-driven: rather than ticking every agent on every
+# time step, it keeps a heap of the times at which messages are due and a
+# heap of agent wakeup times, and jumps straight to the next of either.
+# Agents opt in by implementing next_wakeup(), which returns the network
+# time at which their tick() next does anything (or infinity); it is
+# asked again after each tick and after each message the agent receives.
+# Agents without it are ticked on every step, as are all agents if
+# event_driven is False.
 class NetworkSimulator():
 
-    def __init__(self, latency=50):
+    def __init__(self, latency=50, event_driven=True):
         self.agents = []
         self.latency_distribution_sample = transform(normal_distribution(latency, (latency * 2) // 5), lambda x: max(x, 0))
         self.time = 0
         self.objqueue = {}
+        # Heap of times that have an entry in objqueue
+        self.objqueue_times = []
         self.peers = {}
         self.reliability = 0.9
+        self.event_driven = event_driven
+        # Heap of (wakeup time, agent index), possibly with stale entries;
+        # an entry is live only if it matches the agent's wakeup_times entry
+        self.wakeups = []
+        self.wakeup_times = []
+        # The agent list the heap was built from, and its index by agent ID
+        self.scheduled_agents = None
+        self.agent_indices = {}
 
     def generate_peers(self, num_peers=5):
         self.peers = {}
@@ -24,34 +43,92 @@ class NetworkSimulator():
             for peer in p:
                 self.peers[peer.id] = self.peers.get(peer.id, []) + [a]
 
-    def tick(self):
+    # Is every agent able to tell us when it next needs to be ticked?
+    def can_schedule(self):
+        if not self.event_driven:
+            return False
+        if self.scheduled_agents is not self.agents or len(self.wakeup_times) != len(self.agents):
+            if not all(hasattr(a, 'next_wakeup') for a in self.agents):
+                return False
+            self.wakeup_times = [a.next_wakeup() for a in self.agents]
+            self.wakeups = [(t, i) for i, t in enumerate(self.wakeup_times)]
+            heapq.heapify(self.wakeups)
+            self.agent_indices = {a.id: i for i, a in enumerate(self.agents)}
+            self.scheduled_agents = self.agents
+        return True
+
+    # Ask agent i when it next needs ticking, no earlier than not_before
+    def reschedule(self, i, not_before):
+        t = max(self.agents[i].next_wakeup(), not_before)
+        if t != self.wakeup_times[i]:
+            self.wakeup_times[i] = t
+            heapq.heappush(self.wakeups, (t, i))
+
+    # Deliver the messages due at the current time, then tick the agents
+    def process(self, scheduled):
         if self.time in self.objqueue:
             for recipient, obj in self.objqueue[self.time]:
                 if random.random() < self.reliability:
                     recipient.on_receive(obj)
+                    # The message may have given the agent something to do
+                    if scheduled:
+                        self.reschedule(self.agent_indices[recipient.id], self.time)
             del self.objqueue[self.time]
-        for a in self.agents:
-            a.tick()
+        while self.objqueue_times and self.objqueue_times[0] <= self.time:
+            heapq.heappop(self.objqueue_times)
+        if not scheduled:
+            for a in self.agents:
+                a.tick()
+            return
+        # Only tick agents that are due, in the same order as the agent list
+        due = set()
+        while self.wakeups and self.wakeups[0][0] <= self.time:
+            t, i = heapq.heappop(self.wakeups)
+            if t == self.wakeup_times[i]:
+                due.add(i)
+        for i in sorted(due):
+            self.agents[i].tick()
+            self.reschedule(i, self.time + 1)
+
+    def tick(self):
+        self.process(self.can_schedule())
         self.time += 1
 
     def run(self, steps):
-        for i in range(steps):
-            self.tick()
+        end_time = self.time + steps
+        while self.time < end_time:
+            if not self.can_schedule():
+                self.tick()
+                continue
+            # Jump to the next delivery or agent wakeup
+            next_time = end_time
+            if self.wakeups:
+                next_time = min(next_time, self.wakeups[0][0])
+            if self.objqueue_times:
+                next_time = min(next_time, self.objqueue_times[0])
+            if next_time >= end_time:
+                break
+            self.time = max(self.time, int(next_time))
+            self.process(True)
+            self.time += 1
+        self.time = max(self.time, end_time)
+
+    def enqueue(self, recv_time, recipient, obj):
+        if recv_time not in self.objqueue:
+            self.objqueue[recv_time] = []
+            heapq.heappush(self.objqueue_times, recv_time)
+        self.objqueue[recv_time].append((recipient, obj))
 
     def broadcast(self, sender, obj):
         for p in self.peers[sender.id]:
             recv_time = self.time + self.latency_distribution_sample()
-            if recv_time not in self.objqueue:
-                self.objqueue[recv_time] = []
-            self.objqueue[recv_time].append((p, obj))
+            self.enqueue(recv_time, p, obj)
 
     def direct_send(self, to_id, obj):
         for a in self.agents:
             if a.id == to_id:
                 recv_time = self.time + self.latency_distribution_sample()
-                if recv_time not in self.objqueue:
-                    self.objqueue[recv_time] = []
-                self.objqueue[recv_time].append((a, obj))
+                self.enqueue(recv_time, a, obj)
 
     def knock_offline_random(self, n):
         ko = {}
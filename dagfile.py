@@ -0,0 +1,101 @@
+import array
+import json
+import sys
+
+# An on-disk record of the block DAG from one simulation run, holding
+# everything the reward accounting needs, so that payouts under other
+# reward schedules can be worked out later without re-simulating.
+#
+# Blocks are numbered in the order they were made, genesis blocks first,
+# and stored by column. The file is one line of JSON header, giving the
+# miners, the head of the chain and the run's parameters, followed by
+# these arrays of 32-bit ints in the writer's byte order:
+#
+#     parents, makers, heights, times, uncle_counts    (one per block)
+#     uncles                     (each block's uncles, one block after another)
+#
+# Makers are miner indices, or -1 for genesis blocks.
+
+FORMAT_VERSION = 1
+TYPECODE = 'i'
+COLUMNS = ('parents', 'makers', 'heights', 'times', 'uncle_counts')
+
+
+class RecordedDAG():
+    def __init__(self, header, columns, uncles):
+        # Group of each miner, eg. its hashpower and strategy, as a string
+        self.groups = header['groups']
+        # The group whose mean profit the others are measured against
+        self.baseline_group = header.get('baseline_group')
+        self.head = header['head']
+        self.genesis_blocks = header['genesis_blocks']
+        self.rounds = header['rounds']
+        # The reward coefficients the run was made with
+        self.rewards = header['rewards']
+        self.params = header.get('params', {})
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+        self.uncles = uncles
+        # Where each block's uncles start in self.uncles
+        self.uncle_starts = array.array(TYPECODE, [0]) * (len(self.parents) + 1)
+        for i, c in enumerate(self.uncle_counts):
+            self.uncle_starts[i + 1] = self.uncle_starts[i] + c
+
+    def __len__(self):
+        return len(self.parents)
+
+    def uncles_of(self, b):
+        return self.uncles[self.uncle_starts[b]:self.uncle_starts[b + 1]]
+
+
+# Write a DAG to path. blocks is a list of (parent, maker, height, time,
+# uncles) in order of block number; groups is the group of each miner;
+# rewards maps reward coefficient names to the values used in the run
+def write(path, blocks, groups, head, genesis_blocks, rounds, rewards,
+          baseline_group=None, params=None):
+    columns = [array.array(TYPECODE) for name in COLUMNS]
+    uncles = array.array(TYPECODE)
+    for parent, maker, height, time, block_uncles in blocks:
+        for column, v in zip(columns, (parent, maker, height, time, len(block_uncles))):
+            column.append(v)
+        uncles.extend(block_uncles)
+    header = {
+        'format': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'itemsize': uncles.itemsize,
+        'blocks': len(blocks),
+        'total_uncles': len(uncles),
+        'groups': groups,
+        'baseline_group': baseline_group,
+        'head': head,
+        'genesis_blocks': genesis_blocks,
+        'rounds': rounds,
+        'rewards': rewards,
+        'params': params or {},
+    }
+    f = open(path, 'wb')
+    try:
+        f.write(json.dumps(header, sort_keys=True) + '\n')
+        for column in columns + [uncles]:
+            column.tofile(f)
+    finally:
+        f.close()
+
+
+def read(path):
+    f = open(path, 'rb')
+    try:
+        header = json.loads(f.readline())
+        if header['format'] != FORMAT_VERSION:
+            raise ValueError('%s: unknown DAG file format %r' % (path, header['format']))
+        if header['itemsize'] != array.array(TYPECODE).itemsize:
+            raise ValueError('%s: written with %d-byte ints' % (path, header['itemsize']))
+        columns = {}
+        for name in COLUMNS + ('uncles',):
+            columns[name] = array.array(TYPECODE)
+            columns[name].fromfile(f, header['total_uncles'] if name == 'uncles' else header['blocks'])
+            if header['byteorder'] != sys.byteorder:
+                columns[name].byteswap()
+    finally:
+        f.close()
+    return RecordedDAG(header, columns, columns.pop('uncles'))
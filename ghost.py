@@ -12,97 +12,149 @@ NEPHEW_REWARD_COEFF = 1/32.
 # Rounds to test
 ROUNDS = 1000000
 
+import os
 import random
+import dagfile
+import tracesink
+from timingwheel import TimingWheel
+from powsampler import PowSampler
 
-all_miners = {}
+# Where to record the block DAG at the end of a run, for rescore.py
+DAG_FILE = os.environ.get('DAG_FILE')
+
+# The blocks made in one simulation, shared by all of its miners as blocks
+# never change once made. Blocks are numbered in the order they are made,
+# and each property is kept in a list indexed by block number
+class BlockDAG():
+    def __init__(self, uncle_depth=UNCLE_DEPTH):
+        self.uncle_depth = uncle_depth
+        self.parents = []
+        self.heights = []
+        self.scores = []
+        self.makers = []
+        self.uncle_lists = []
+        self.children = []
+        # The tick each block was made at
+        self.times = []
+        # The random ID of each block, as reported in the output
+        self.block_ids = []
+        # Set up a few genesis blocks (since the algo is grandpa-dependent,
+        # we need two genesis blocks plus some genesis uncles)
+        for i in range(uncle_depth + 2):
+            self.add_block(i - 1, i, i, -1, [], i, 0)
+        self.genesis_blocks = uncle_depth + 2
+
+    def add_block(self, parent, height, score, maker, uncles, id, time):
+        self.parents.append(parent)
+        self.heights.append(height)
+        self.scores.append(score)
+        self.makers.append(maker)
+        self.uncle_lists.append(uncles)
+        self.children.append([])
+        self.times.append(time)
+        self.block_ids.append(id)
+        if parent >= 0:
+            self.children[parent].append(len(self.parents) - 1)
+        return len(self.parents) - 1
+
+    def __len__(self):
+        return len(self.parents)
+
+    # If b1 is the n-th degree grandchild and b2 is the m-th degree
+    # grandchild of nearest common ancestor C, returns min(m, n)
+    def cousin_degree(self, b1, b2):
+        parents, heights = self.parents, self.heights
+        while heights[b1] > heights[b2]:
+            b1 = parents[b1]
+        while heights[b2] > heights[b1]:
+            b2 = parents[b2]
+        t = 0
+        while b1 != b2:
+            b1 = parents[b1]
+            b2 = parents[b2]
+            t += 1
+        return t
 
 
 class Miner():
-    def __init__(self, p, backward=0):
+    def __init__(self, p, backward=0, dag=None):
         # Miner hashpower
         self.hashpower = p
         # Miner mines a few blocks behind the head?
         self.backward = backward
         self.id = random.randrange(10000000)
-        # Set up a few genesis blocks (since the algo is grandpa-dependent,
-        # we need two genesis blocks plus some genesis uncles)
-        self.blocks = {}
-        self.children = {}
-        for i in range(UNCLE_DEPTH + 2):
-            self.blocks[i] = \
-                {"parent": i-1, "uncles": {}, "miner": -1, "height": i,
-                 "score": i, "id": i}
-            self.children[i-1] = {i: True}
-        # ID of "latest block"
-        self.head = UNCLE_DEPTH + 1
+        self.dag = dag
+        if dag is None:
+            return
+        # Flag per block number: has this miner got the block?
+        self.known = bytearray([1]) * dag.genesis_blocks
+        # Number of "latest block"
+        self.head = dag.uncle_depth + 1
+        # The blocks we could include as uncles if we mined now, the
+        # ancestors whose children are eligible, and the blocks that are
+        # ruled out. Recomputed when the head moves, and added to as
+        # blocks arrive in between
+        self.uncles = set()
+        self.uncle_parents = set()
+        self.not_uncles = set()
+        self.uncles_stale = True
 
     # Hear about a block
     def recv(self, block):
+        parents = self.dag.parents
         # Add the block to the set if it's valid
-        addme = True
-        if block["id"] in self.blocks:
-            addme = False
-        if block["parent"] not in self.blocks:
-            addme = False
-        if addme:
-            self.blocks[block["id"]] = block
-            if block["parent"] not in self.children:
-                self.children[block["parent"]] = {}
-            if block["id"] not in self.children[block["parent"]]:
-                self.children[block["parent"]][block["id"]] = block["id"]
-            if block["score"] > self.blocks[self.head]["score"]:
-                self.head = block["id"]
-
-    # Mine a block
-    def mine(self):
-        HEAD = self.blocks[self.head]
+        if block >= len(self.known):
+            self.known.extend(bytearray(block + 1024 - len(self.known)))
+        if self.known[block] or not self.known[parents[block]]:
+            return
+        self.known[block] = 1
+        if self.dag.scores[block] > self.dag.scores[self.head]:
+            self.head = block
+            self.uncles_stale = True
+        elif not self.uncles_stale and parents[block] in self.uncle_parents \
+                and block not in self.not_uncles:
+            self.uncles.add(block)
+
+    # Select the uncles. The valid set of uncles for a block consists
+    # of the children of the 2nd to N+1th order grandparents minus
+    # the parent and said grandparents themselves and blocks that were
+    # uncles of those previous blocks. Mining further back shortens the
+    # range, down to no uncles at all when mining back as far as the
+    # uncle depth
+    def update_uncles(self):
+        dag = self.dag
+        depth = max(dag.uncle_depth - self.backward, 0)
+        ancestors = [self.head]
+        for i in range(max(depth, self.backward)):
+            ancestors.append(dag.parents[ancestors[-1]])
+        self.uncle_parents = set(ancestors[1:depth + 1])
+        self.not_uncles = set()
+        if depth > 0:
+            for b in [ancestors[self.backward]] + ancestors[1:depth]:
+                self.not_uncles.add(b)
+                self.not_uncles.update(dag.uncle_lists[b])
+        known, n = self.known, len(self.known)
+        self.uncles = set([c for b in self.uncle_parents for c in dag.children[b]
+                           if c < n and known[c] and c not in self.not_uncles])
+        self.uncles_stale = False
+
+    # Mine a block at tick t
+    def mine(self, t):
+        dag = self.dag
+        if self.uncles_stale:
+            self.update_uncles()
+        base = self.head
         for i in range(self.backward):
-            HEAD = self.blocks[HEAD["parent"]]
-        H = HEAD
-        h = self.blocks[self.blocks[self.head]["parent"]]
-        # Select the uncles. The valid set of uncles for a block consists
-        # of the children of the 2nd to N+1th order grandparents minus
-        # the parent and said grandparents themselves and blocks that were
-        # uncles of those previous blocks
-        u = {}
-        notu = {}
-        for i in range(UNCLE_DEPTH - self.backward):
-            for c in self.children.get(h["id"], {}):
-                u[c] = True
-            notu[H["id"]] = True
-            for c in H["uncles"]:
-                notu[c] = True
-            H = h
-            h = self.blocks[h["parent"]]
-        for i in notu:
-            if i in u:
-                del u[i]
-        block = {"parent": self.head, "uncles": u, "miner": self.id,
-                 "height": HEAD["height"] + 1, "score": HEAD["score"]+1+len(u),
-                 "id": random.randrange(1000000000000)}
+            base = dag.parents[base]
+        block = dag.add_block(self.head, dag.heights[base] + 1, dag.scores[base] + 1 + len(self.uncles),
+                              self.id, sorted(self.uncles), random.randrange(1000000000000), t)
         self.recv(block)
-        global all_miners
-        all_miners[block["id"]] = block
         return block
 
 
-# If b1 is the n-th degree grandchild and b2 is the m-th degree grandchild
-# of nearest common ancestor C, returns min(m, n)
-def cousin_degree(miner, b1, b2):
-    while miner.blocks[b1]["height"] > miner.blocks[b2]["height"]:
-        b1 = miner.blocks[b1]["parent"]
-    while miner.blocks[b2]["height"] > miner.blocks[b1]["height"]:
-        b2 = miner.blocks[b2]["parent"]
-    t = 0
-    while b1 != b2:
-        b1 = miner.blocks[b1]["parent"]
-        b2 = miner.blocks[b2]["parent"]
-        t += 1
-    return t
-
 # Set hashpower percentages and strategies
 # Strategy = how many blocks behind head you mine
-profiles = [
+PROFILES = [
     # (hashpower, strategy, count)
     (1, 0, 20),
     (1, 1, 4),  # cheaters, mine 1/2/4 blocks back to reduce
@@ -114,84 +166,139 @@ profiles = [
     (25, 0, 1),
 ]
 
-total_pct = 0
-miners = []
-for p, b, c in profiles:
-    for i in range(c):
-        miners.append(Miner(p, b))
-        total_pct += p
 
-miner_dict = {}
-for m in miners:
-    miner_dict[m.id] = m
+# Run the mining simulation. Returns the block DAG and the miners
+def simulate(profiles=PROFILES, uncle_depth=UNCLE_DEPTH, rounds=ROUNDS,
+             pow_solution_time=POW_SOLUTION_TIME, transit_time=TRANSIT_TIME):
+    dag = BlockDAG(uncle_depth)
+    total_pct = 0
+    miners = []
+    for p, b, c in profiles:
+        for i in range(c):
+            miners.append(Miner(p, b, dag))
+            total_pct += p
 
-listen_queue = []
+    # Blocks in transit, by arrival tick
+    listen_queue = TimingWheel(transit_time + 1)
 
-for t in range(ROUNDS):
-    if t % 5000 == 0:
-        print t
-    for m in miners:
-        R = random.randrange(POW_SOLUTION_TIME * total_pct)
-        if R < m.hashpower and t < ROUNDS - TRANSIT_TIME * 3:
-            b = m.mine()
-            listen_queue.append([t + TRANSIT_TIME, b])
-    while len(listen_queue) and listen_queue[0][0] <= t:
-        t, b = listen_queue.pop(0)
+    # Jump from one block to the next, rather than trying every miner on
+    # every round. Blocks arriving in a round are heard after that round's
+    # blocks are mined
+    pow_sampler = PowSampler([m.hashpower for m in miners], pow_solution_time * total_pct)
+    next_report = 0
+    for t, i in pow_sampler.blocks(rounds - transit_time * 3):
+        while next_report <= t:
+            tracesink.emit(tracesink.PROGRESS, 'round', round=next_report, rounds=rounds)
+            next_report += 5000
+        for b in listen_queue.pop_due(t - 1):
+            for m in miners:
+                m.recv(b)
+        listen_queue.schedule(t + transit_time, miners[i].mine(t))
+    for b in listen_queue.pop_due(rounds - 1):
         for m in miners:
             m.recv(b)
+    return dag, miners
+
+
+# Walk the chain back from a head, paying out block, uncle and nephew
+# rewards. Returns each miner's profit, the number of blocks and uncles
+# in the chain, and its length
+def chain_rewards(dag, head, uncle_reward_coeff=UNCLE_REWARD_COEFF,
+                  uncle_depth_penalty=UNCLE_DEPTH_PENALTY,
+                  nephew_reward_coeff=NEPHEW_REWARD_COEFF):
+    makers, heights, uncle_lists = dag.makers, dag.heights, dag.uncle_lists
+    h = head
+    profit = {}
+    total_blocks_in_chain = 0
+    length_of_chain = 0
+    while h >= dag.genesis_blocks:
+        # print dag.block_ids[h], makers[h], heights[h], dag.scores[h]
+        # print "Uncles: ", [dag.block_ids[u] for u in uncle_lists[h]]
+        total_blocks_in_chain += 1 + len(uncle_lists[h])
+        length_of_chain += 1
+        profit[makers[h]] = profit.get(makers[h], 0) + \
+            1 + nephew_reward_coeff * len(uncle_lists[h])
+        for u in uncle_lists[h]:
+            profit[makers[u]] \
+                = profit.get(makers[u], 0) + uncle_reward_coeff - uncle_depth_penalty * (heights[h] - heights[u])
+        h = dag.parents[h]
+    return profit, total_blocks_in_chain, length_of_chain
+
+
+# Total profit and number of miners of each strategy, keyed by
+# "hashpower,backward"
+def group_profits(profit, miners):
+    miner_dict = {}
+    for m in miners:
+        miner_dict[m.id] = m
+    groupings = {}
+    counts = {}
+    for p in profit:
+        m = miner_dict.get(p, None)
+        if m:
+            h = str(m.hashpower)+','+str(m.backward)
+            counts[h] = counts.get(h, 0) + 1
+            groupings[h] = groupings.get(h, 0) + profit[p]
+    return groupings, counts
+
+
+# Record a DAG and the chain ending at head to path, with miners
+# grouped by strategy
+def write_dag(path, dag, miners, head, rounds=ROUNDS,
+              uncle_reward_coeff=UNCLE_REWARD_COEFF,
+              uncle_depth_penalty=UNCLE_DEPTH_PENALTY,
+              nephew_reward_coeff=NEPHEW_REWARD_COEFF):
+    index = dict((m.id, i) for i, m in enumerate(miners))
+    index[-1] = -1
+    blocks = zip(dag.parents, [index[m] for m in dag.makers], dag.heights,
+                 dag.times, dag.uncle_lists)
+    dagfile.write(path, blocks, [str(m.hashpower)+','+str(m.backward) for m in miners],
+                  head, dag.genesis_blocks, rounds,
+                  {'uncle_reward_coeff': uncle_reward_coeff,
+                   'uncle_depth_penalty': uncle_depth_penalty,
+                   'nephew_reward_coeff': nephew_reward_coeff},
+                  baseline_group='1,0', params={'uncle_depth': dag.uncle_depth})
+
+
+# Run one simulation and print its chain, heads, profits and results
+def main():
+    dag, miners = simulate()
+    if DAG_FILE:
+        write_dag(DAG_FILE, dag, miners, miners[0].head)
+    miner_dict = {}
+    for m in miners:
+        miner_dict[m.id] = m
+    tracesink.flush()
+    print "### PRINTING BLOCKCHAIN ###"
+    profit, total_blocks_in_chain, length_of_chain = chain_rewards(dag, miners[0].head)
+
+    print "### PRINTING HEADS ###"
+
+    for m in miners:
+        print dag.block_ids[m.head]
+
+
+    print "### PRINTING PROFITS ###"
+
+    for p in profit:
+        print miner_dict.get(p, Miner(0)).hashpower, profit.get(p, 0)
+
+    print "### PRINTING RESULTS ###"
+
+    groupings, counts = group_profits(profit, miners)
+    for c in counts:
+        print c, groupings[c] / counts[c] / (groupings['1,0'] / counts['1,0'])
+
+    blocks_mined = len(dag) - dag.genesis_blocks
+    print " "
+    print "Total blocks produced: ", blocks_mined - dag.uncle_depth
+    print "Total blocks in chain: ", total_blocks_in_chain
+    print "Efficiency: ", \
+        total_blocks_in_chain * 1.0 / (blocks_mined - dag.uncle_depth)
+    print "Average uncles: ", total_blocks_in_chain * 1.0 / length_of_chain - 1
+    print "Length of chain: ", length_of_chain
+    print "Block time: ", ROUNDS * 1.0 / length_of_chain
+
 
-h = miners[0].blocks[miners[0].head]
-profit = {}
-total_blocks_in_chain = 0
-length_of_chain = 0
-ZORO = {}
-print "### PRINTING BLOCKCHAIN ###"
-
-while h["id"] > UNCLE_DEPTH + 2:
-    # print h["id"], h["miner"], h["height"], h["score"]
-    # print "Uncles: ", list(h["uncles"])
-    total_blocks_in_chain += 1 + len(h["uncles"])
-    ZORO[h["id"]] = True
-    length_of_chain += 1
-    profit[h["miner"]] = profit.get(h["miner"], 0) + \
-        1 + NEPHEW_REWARD_COEFF * len(h["uncles"])
-    for u in h["uncles"]:
-        ZORO[u] = True
-        u2 = miners[0].blocks[u]
-        profit[u2["miner"]] \
-            = profit.get(u2["miner"], 0) + UNCLE_REWARD_COEFF - UNCLE_DEPTH_PENALTY * (h["height"] - u2["height"])
-    h = miners[0].blocks[h["parent"]]
-
-print "### PRINTING HEADS ###"
-
-for m in miners:
-    print m.head
-
-
-print "### PRINTING PROFITS ###"
-
-for p in profit:
-    print miner_dict.get(p, Miner(0)).hashpower, profit.get(p, 0)
-
-print "### PRINTING RESULTS ###"
-
-groupings = {}
-counts = {}
-for p in profit:
-    m = miner_dict.get(p, None)
-    if m:
-        h = str(m.hashpower)+','+str(m.backward)
-        counts[h] = counts.get(h, 0) + 1
-        groupings[h] = groupings.get(h, 0) + profit[p]
-
-for c in counts:
-    print c, groupings[c] / counts[c] / (groupings['1,0'] / counts['1,0'])
-
-print " "
-print "Total blocks produced: ", len(all_miners) - UNCLE_DEPTH
-print "Total blocks in chain: ", total_blocks_in_chain
-print "Efficiency: ", \
-    total_blocks_in_chain * 1.0 / (len(all_miners) - UNCLE_DEPTH)
-print "Average uncles: ", total_blocks_in_chain * 1.0 / length_of_chain - 1
-print "Length of chain: ", length_of_chain
-print "Block time: ", ROUNDS * 1.0 / length_of_chain
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import itertools
+import multiprocessing
+import random
+import sys
+import ghost
+import rewardtable
+import tracesink
+
+# Runs ghost.py over a grid of parameters and prints a table of the
+# results, one row per parameter combination and mining strategy.
+#
+# The grid maps parameter names to lists of values to try. Miner profiles
+# and uncle depth change the simulation itself, so every combination of
+# them is simulated once, in a process pool. The reward coefficients only
+# change the payouts worked out from the finished chain, so every
+# combination of them is computed from that same block DAG. Parameters
+# left out of the grid keep ghost.py's values.
+#
+# Usage: python ghost_sweep.py [rounds] [seed] [processes]
+
+SIMULATION_PARAMS = ('profiles', 'uncle_depth')
+REWARD_PARAMS = ('uncle_reward_coeff', 'uncle_depth_penalty', 'nephew_reward_coeff')
+DEFAULTS = {
+    'profiles': ghost.PROFILES,
+    'uncle_depth': ghost.UNCLE_DEPTH,
+    'uncle_reward_coeff': ghost.UNCLE_REWARD_COEFF,
+    'uncle_depth_penalty': ghost.UNCLE_DEPTH_PENALTY,
+    'nephew_reward_coeff': ghost.NEPHEW_REWARD_COEFF,
+}
+# Columns of the results table. profiles is the index of the miner
+# profiles in the grid; strategy is "hashpower,backward", and profits
+# are relative to honest miners with hashpower 1. The rest are as in
+# rewardtable.py
+COLUMNS = ('profiles', 'uncle_depth') + REWARD_PARAMS + \
+    ('strategy', 'miners', 'profit', 'relative_profit', 'efficiency', 'average_uncles', 'block_time')
+
+
+def simulation_seed(seed, i):
+    return seed * 1000003 + i
+
+
+# Run one simulation, and work out the results of every reward variant
+# from it
+def run_simulation(args):
+    seed, rounds, profiles_index, profiles, uncle_depth, reward_variants = args
+    tracesink.configure(tracesink.OFF)
+    random.seed(seed)
+    dag, miners = ghost.simulate(profiles, uncle_depth, rounds)
+    blocks_mined = len(dag) - dag.genesis_blocks
+    rows = []
+    for coeffs in reward_variants:
+        profit, total_blocks_in_chain, length_of_chain = ghost.chain_rewards(dag, miners[0].head, *coeffs)
+        groupings, counts = ghost.group_profits(profit, miners)
+        stats = rewardtable.chain_stats(total_blocks_in_chain, length_of_chain, blocks_mined, rounds)
+        fields = dict(zip(REWARD_PARAMS, coeffs))
+        fields.update({'profiles': profiles_index, 'uncle_depth': uncle_depth})
+        rows.extend(rewardtable.group_rows(groupings, counts, '1,0', stats, fields, 'strategy'))
+    return rows
+
+
+def sweep(grid, rounds=ghost.ROUNDS, seed=0, processes=None):
+    values = lambda param: grid.get(param, [DEFAULTS[param]])
+    reward_variants = list(itertools.product(*[values(p) for p in REWARD_PARAMS]))
+    jobs = []
+    for (i, profiles), uncle_depth in itertools.product(enumerate(values('profiles')), values('uncle_depth')):
+        jobs.append((simulation_seed(seed, len(jobs)), rounds, i, profiles, uncle_depth, reward_variants))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(run_simulation, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return [row for rows in results for row in rows]
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    grid = {
+        'uncle_depth': [2, 4, 6],
+        'uncle_reward_coeff': [16/32., 24/32., 32/32.],
+        'uncle_depth_penalty': [0/32., 4/32.],
+    }
+    rewardtable.print_table(sweep(grid, rounds, seed, processes), COLUMNS)
@@ -1,4 +1,5 @@
 import random
+import tracesink
 GENESIS = 0
 LATENCY = 10
 CLOCKOFFSET = 10
@@ -16,24 +17,43 @@ class Block():
     def __init__(self, num, parents):
         self.num = num
         self.parents = parents
+        # The block and all its ancestors, as a bitset with bit
+        # num + 1 set for each (see bit())
+        self.ancestors = bit(num)
+        for p in parents:
+            self.ancestors |= p.ancestors
         if self.num not in all_blocks:
             all_blocks.append(self.num)
 
-def get_ancestors(block, out=None):
-    if out is None:
-        out = {}
-    out[block.num] = True
-    for p in block.parents:
-        if p.num not in out:
-            get_ancestors(p, out)
-    return out
+# The bit for a block number in a bitset of blocks. Block numbers start
+# at -1 for genesis
+def bit(num):
+    return 1 << (num + 1)
+
+# The block numbers in a bitset, highest first
+def bitset_nums(bits):
+    while bits:
+        num = bits.bit_length() - 2
+        yield num
+        bits ^= bit(num)
 
 class Miner():
     def __init__(self):
         self.heads = [Block(-1, [])]
         self.listen_queue = {}
         self.blocks = {-1: self.heads[0]}
-        self.scores = {}
+        # Bitset of the blocks in self.blocks
+        self.block_bits = self.heads[0].ancestors
+        # A block's score is the number of blocks received so far that
+        # have it as an ancestor (or are it). Nearly every block received
+        # after a block has it as an ancestor, so rather than add to the
+        # scores of all its ancestors for each block received, count the
+        # blocks received, and for each block, how many of them did not
+        # have it as an ancestor. See score()
+        self.received = 0
+        self.unscored = {}
+        # Bitset of the blocks with a score
+        self.scored = 0
         self.children = {}
         self.id = next_id[0]
         next_id[0] += 1
@@ -48,7 +68,8 @@ class Miner():
             new_blk = Block(t, self.heads[:2])
             for h in self.heads:
                 assert new_blk.num > h.num, (new_blk, self.heads)
-            print 'new block: %d, parents: %r' % (t, map(lambda x: x.num, self.heads[:2]))
+            if tracesink.level >= tracesink.EVENT:
+                tracesink.emit(tracesink.EVENT, 'block', num=t, parents=[x.num for x in self.heads[:2]])
             for miner in miners:
                 recv_time = t + 1 + random.randrange(LATENCY)
                 if recv_time not in miner.listen_queue:
@@ -73,40 +94,54 @@ class Miner():
                         self.request_block(p.num)
                         have_parents = False
                 if not have_parents:
-                    print 'no parents :('
+                    if tracesink.level >= tracesink.DETAIL:
+                        tracesink.emit(tracesink.DETAIL, 'missing_parents', miner=self.id, block=blk.num)
                     continue
                 self.blocks[blk.num] = blk
+                self.block_bits |= bit(blk.num)
                 for p in blk.parents:
                     if p.num not in self.children:
                         self.children[p.num] = set([])
                     self.children[p.num].add(blk.num)
-                print 'getting ancestors for %r (%d)' % (blk , blk.num)
-                anc = list(get_ancestors(blk).keys())
-                print 'ancestors', anc
-                for num in anc:
-                    self.scores[num] = self.scores.get(num, 0) + 1
-                if len(self.scores):
-                    head = self.get_head()
-                    print 'head', head
-                    head_ancestors = get_ancestors(self.blocks[head])
-                    head2_candidates = [(x,y) for x,y in self.blocks.items() if x not in head_ancestors]
-                    self.heads = [self.blocks[head]]
-                    if len(head2_candidates):
-                        head2 = max(head2_candidates)[1]
-                        self.heads.append(head2)
-                else:
-                    self.heads = []
+                if tracesink.level >= tracesink.DETAIL:
+                    tracesink.emit(tracesink.DETAIL, 'ancestors', miner=self.id, block=blk.num,
+                                   ancestors=list(bitset_nums(blk.ancestors)))
+                self.add_score(blk)
+                head = self.get_head()
+                if tracesink.level >= tracesink.DETAIL:
+                    tracesink.emit(tracesink.DETAIL, 'head', miner=self.id, head=head)
+                # The second head is the highest-numbered block that
+                # isn't an ancestor of the head
+                head2_candidates = self.block_bits & ~self.blocks[head].ancestors
+                self.heads = [self.blocks[head]]
+                if head2_candidates:
+                    self.heads.append(self.blocks[head2_candidates.bit_length() - 2])
             del self.listen_queue[t]
 
+    # Add one to the score of a block and each of its ancestors
+    def add_score(self, blk):
+        for num in bitset_nums(blk.ancestors & ~self.scored):
+            self.unscored[num] = self.received
+        for num in bitset_nums(self.scored & ~blk.ancestors):
+            self.unscored[num] += 1
+        self.scored |= blk.ancestors
+        self.received += 1
+
+    def score(self, num):
+        return self.received - self.unscored[num]
+
     def get_head(self):
         h = -1
+        received, unscored = self.received, self.unscored
         while h in self.children and self.children[h]:
             best_child = None
             best_score = -9999
             for c in self.children[h]:
-                if self.scores[c] > best_score:
+                # self.score(c), inlined as this is the inner loop
+                score = received - unscored[c]
+                if score > best_score:
                     best_child = c
-                    best_score = self.scores[c]
+                    best_score = score
             h = best_child
         return h
 
@@ -136,6 +171,7 @@ for i in range(RUNTIME):
         m.mine()
         m.listen()
     time[0] += 1
+tracesink.flush()
 
 totcs = []
 
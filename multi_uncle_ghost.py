@@ -11,8 +11,14 @@ NEPHEW_REWARD_COEFF = 0.01
 # Rounds to test
 ROUNDS = 80000
 
+import os
 import random
-import copy
+import dagfile
+from timingwheel import TimingWheel
+from powsampler import PowSampler
+
+# Where to record the block DAG at the end of a run, for rescore.py
+DAG_FILE = os.environ.get('DAG_FILE')
 
 
 class Miner():
@@ -23,10 +29,13 @@ class Miner():
         # we need two genesis blocks plus some genesis uncles)
         self.blocks = {
             0: {"parent": -1, "uncles": [], "miner": -1, "height": 0,
-                "score": 0, "id": 0, "children": {1: 1}},
+                "score": 0, "id": 0},
             1: {"parent": 0, "uncles": [], "miner": -1, "height": 1,
-                "score": 0, "id": 1, "children": {}}
+                "score": 0, "id": 1}
         }
+        # The children of each block, as far as this miner knows. Blocks
+        # themselves are never modified, so all miners share them
+        self.children = {0: {1: 1}, 1: {}}
         # ID of "latest block"
         self.head = 1
 
@@ -41,17 +50,18 @@ class Miner():
         for u in block["uncles"]:
             if u not in self.blocks:
                 addme = False
-        p = self.blocks[block["parent"]]
+        siblings = self.children[block["parent"]]
         if addme:
-            self.blocks[block["id"]] = copy.deepcopy(block)
+            self.blocks[block["id"]] = block
+            self.children[block["id"]] = {}
             # Each parent keeps track of its children, to help
             # facilitate the rule that a block must have N+ siblings
             # to be valid
-            if block["id"] not in p["children"]:
-                p["children"][block["id"]] = block["id"]
+            if block["id"] not in siblings:
+                siblings[block["id"]] = block["id"]
             # Check if the new block deserves to be the new head
-            if len(p["children"]) >= 1 + UNCLES:
-                for c in p["children"]:
+            if len(siblings) >= 1 + UNCLES:
+                for c in siblings:
                     newblock = self.blocks[c]
                     if newblock["score"] > self.blocks[self.head]["score"]:
                         self.head = newblock["id"]
@@ -59,11 +69,11 @@ class Miner():
     # Mine a block
     def mine(self):
         h = self.blocks[self.blocks[self.head]["parent"]]
-        b = sorted(list(h["children"]), key=lambda x: -self.blocks[x]["score"])
+        b = sorted(list(self.children[h["id"]]), key=lambda x: -self.blocks[x]["score"])
         p = self.blocks[b[0]]
         block = {"parent": b[0], "uncles": b[1:], "miner": self.id,
                  "height": h["height"] + 2, "score": p["score"] + len(b),
-                 "id": random.randrange(1000000000000), "children": {}}
+                 "id": random.randrange(1000000000000)}
         self.recv(block)
         return block
 
@@ -89,20 +99,30 @@ miner_dict = {}
 for m in miners:
     miner_dict[m.id] = m
 
-listen_queue = []
-
-for t in range(ROUNDS):
-    if t % 5000 == 0:
-        print t
-    for m in miners:
-        R = random.randrange(POW_SOLUTION_TIME * sum(percentages))
-        if R < m.hashpower and t < ROUNDS - TRANSIT_TIME * 3:
-            b = m.mine()
-            listen_queue.append([t + TRANSIT_TIME, b])
-    while len(listen_queue) and listen_queue[0][0] <= t:
-        t, b = listen_queue.pop(0)
+# Every block mined, and the tick it was mined at
+mined = []
+
+# Blocks in transit, by arrival tick
+listen_queue = TimingWheel(TRANSIT_TIME + 1)
+
+# Jump from one block to the next, rather than trying every miner on
+# every round. Blocks arriving in a round are heard after that round's
+# blocks are mined
+pow_sampler = PowSampler([m.hashpower for m in miners], POW_SOLUTION_TIME * sum(percentages))
+next_report = 0
+for t, i in pow_sampler.blocks(ROUNDS - TRANSIT_TIME * 3):
+    while next_report <= t:
+        print next_report
+        next_report += 5000
+    for b in listen_queue.pop_due(t - 1):
         for m in miners:
             m.recv(b)
+    block = miners[i].mine()
+    mined.append((t, block))
+    listen_queue.schedule(t + TRANSIT_TIME, block)
+for b in listen_queue.pop_due(ROUNDS - 1):
+    for m in miners:
+        m.recv(b)
 
 h = miners[0].blocks[miners[0].head]
 profit = {}
@@ -154,3 +174,17 @@ print "Efficiency: ", total_blocks_in_chain * 1.0 / (len(miners[0].blocks) - 2)
 print "Average uncles: ", total_blocks_in_chain * 1.0 / length_of_chain
 print "Length of chain: ", length_of_chain
 print "Block time: ", ROUNDS * 1.0 / length_of_chain
+
+if DAG_FILE:
+    miner_index = dict((m.id, i) for i, m in enumerate(miners))
+    genesis = [miners[0].blocks[0], miners[0].blocks[1]]
+    block_index = dict((b["id"], i) for i, b in enumerate(genesis + [b for t, b in mined]))
+    dagfile.write(DAG_FILE,
+                  [(b["parent"], -1, b["height"], 0, []) for b in genesis] +
+                  [(block_index[b["parent"]], miner_index[b["miner"]], b["height"], t,
+                    [block_index[u] for u in b["uncles"]]) for t, b in mined],
+                  [str(m.hashpower) for m in miners], block_index[miners[0].head], len(genesis), ROUNDS,
+                  {'uncle_reward_coeff': UNCLE_REWARD_COEFF,
+                   'uncle_depth_penalty': 0,
+                   'nephew_reward_coeff': NEPHEW_REWARD_COEFF},
+                  baseline_group='1', params={'uncles': UNCLES})
@@ -0,0 +1,33 @@
+import heapq
+import math
+import random
+
+# Samples proof-of-work solutions for a set of miners without stepping
+# through every tick. On each tick, miner i finds a block with probability
+# hashpowers[i] / difficulty, independently of the others, so the number
+# of ticks until its next block is geometric. The tick of each miner's
+# next block is kept in a heap, and the sampler jumps straight from one
+# block to the next with one random draw per block.
+
+
+class PowSampler():
+    def __init__(self, hashpowers, difficulty, start=0):
+        # Log of each miner's chance of not finding a block in a tick
+        self.log_miss = [math.log(1 - h * 1.0 / difficulty) for h in hashpowers]
+        self.heap = [(self.next_block(i, start - 1), i) for i in range(len(hashpowers))]
+        heapq.heapify(self.heap)
+
+    # The tick of miner i's first block after tick t
+    def next_block(self, i, t):
+        # A miner without hashpower never finds one
+        if self.log_miss[i] == 0:
+            return float('inf')
+        return t + 1 + int(math.log(1.0 - random.random()) / self.log_miss[i])
+
+    # Yield (tick, miner index) for every block found before tick end, in
+    # order of tick, and of miner index within a tick
+    def blocks(self, end):
+        while self.heap and self.heap[0][0] < end:
+            t, i = self.heap[0]
+            heapq.heapreplace(self.heap, (self.next_block(i, t), i))
+            yield t, i
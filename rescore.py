@@ -0,0 +1,97 @@
+import itertools
+import sys
+import dagfile
+import rewardtable
+
+# Works out payouts under many reward schedules from block DAGs recorded
+# by ghost.py or multi_uncle_ghost.py (run with DAG_FILE set), without
+# re-simulating, and prints a table of the results, one row per DAG file,
+# reward schedule and group of miners.
+#
+# A miner's profit is linear in the reward coefficients: one for each of
+# its blocks in the chain, nephew_reward_coeff for each uncle those
+# blocks include, and uncle_reward_coeff less uncle_depth_penalty per
+# block of depth for each of its blocks included as an uncle. So the
+# chain is walked once per DAG to count those up for every miner, and
+# each schedule after that costs one multiply-add per count.
+#
+# The columns are as in rewardtable.py, with profits relative to the
+# group the DAG's run names as its baseline.
+#
+# Usage: python rescore.py dagfile [dagfile ...]
+
+REWARD_PARAMS = ('uncle_reward_coeff', 'uncle_depth_penalty', 'nephew_reward_coeff')
+COLUMNS = ('file',) + REWARD_PARAMS + \
+    ('group', 'miners', 'profit', 'relative_profit', 'efficiency', 'average_uncles', 'block_time')
+
+
+# Per-miner counts from walking the chain back from the head of a DAG
+class ChainTally():
+    def __init__(self, dag):
+        miners = len(dag.groups)
+        # Blocks in the chain made by each miner
+        self.blocks = [0] * miners
+        # Uncles included by those blocks
+        self.nephews = [0] * miners
+        # Blocks made by each miner that were included as uncles, and
+        # their total depth below the blocks including them
+        self.uncles = [0] * miners
+        self.uncle_depths = [0] * miners
+        self.total_blocks_in_chain = 0
+        self.length_of_chain = 0
+        makers, heights, parents = dag.makers, dag.heights, dag.parents
+        h = dag.head
+        while h >= dag.genesis_blocks:
+            uncles = dag.uncles_of(h)
+            self.total_blocks_in_chain += 1 + len(uncles)
+            self.length_of_chain += 1
+            self.blocks[makers[h]] += 1
+            self.nephews[makers[h]] += len(uncles)
+            for u in uncles:
+                if makers[u] >= 0:
+                    self.uncles[makers[u]] += 1
+                    self.uncle_depths[makers[u]] += heights[h] - heights[u]
+            h = parents[h]
+
+    # Each miner's profit under a reward schedule
+    def profits(self, uncle_reward_coeff, uncle_depth_penalty, nephew_reward_coeff):
+        return [b + nephew_reward_coeff * n + uncle_reward_coeff * u - uncle_depth_penalty * d
+                for b, n, u, d in zip(self.blocks, self.nephews, self.uncles, self.uncle_depths)]
+
+
+# Rows of results for one DAG under every schedule in a grid mapping
+# reward parameter names to lists of values to try. Parameters left out
+# of the grid keep the values the DAG was made with
+def rescore(dag, grid, name=''):
+    tally = ChainTally(dag)
+    values = lambda param: grid.get(param, [dag.rewards[param]])
+    # Only miners that got something count towards their group's mean,
+    # as in the simulators' own results
+    paid = [i for i in range(len(dag.groups)) if tally.blocks[i] or tally.uncles[i]]
+    counts = {}
+    for i in paid:
+        counts[dag.groups[i]] = counts.get(dag.groups[i], 0) + 1
+    stats = rewardtable.chain_stats(tally.total_blocks_in_chain, tally.length_of_chain,
+                                    len(dag) - dag.genesis_blocks, dag.rounds)
+    rows = []
+    for coeffs in itertools.product(*[values(p) for p in REWARD_PARAMS]):
+        profits = tally.profits(*coeffs)
+        groupings = {}
+        for i in paid:
+            groupings[dag.groups[i]] = groupings.get(dag.groups[i], 0) + profits[i]
+        fields = dict(zip(REWARD_PARAMS, coeffs))
+        fields['file'] = name
+        rows.extend(rewardtable.group_rows(groupings, counts, dag.baseline_group, stats, fields))
+    return rows
+
+
+if __name__ == '__main__':
+    grid = {
+        'uncle_reward_coeff': [16/32., 24/32., 28/32., 32/32.],
+        'uncle_depth_penalty': [0/32., 2/32., 4/32.],
+        'nephew_reward_coeff': [0/32., 1/32.],
+    }
+    rows = []
+    for path in sys.argv[1:]:
+        rows.extend(rescore(dagfile.read(path), grid, path))
+    rewardtable.print_table(rows, COLUMNS)
@@ -0,0 +1,59 @@
+import sys
+
+# Rows and tables of per-group results from a finished chain, shared by
+# ghost_sweep.py and rescore.py, so that the same column means the same
+# thing in both. Each row gives, for one group of miners:
+#
+#     miners            number of miners in the group that got anything
+#     profit            the group's mean profit per miner
+#     relative_profit   profit divided by the baseline group's (nan
+#                       without one)
+#
+# and, for the chain the payouts came from:
+#
+#     efficiency        blocks in the chain, uncles included, as a
+#                       fraction of all blocks mined
+#     average_uncles    uncles included per block in the chain
+#     block_time        rounds per block in the chain
+#
+# The summaries ghost.py and multi_uncle_ghost.py print at the end of a
+# run keep their own, older definitions of efficiency and average uncles.
+
+
+# Chain-wide columns, given the blocks in the chain including uncles,
+# the number of blocks in the chain itself, the number of blocks mined
+# (excluding genesis blocks) and the number of rounds simulated
+def chain_stats(total_blocks_in_chain, length_of_chain, blocks_mined, rounds):
+    return {
+        'efficiency': total_blocks_in_chain * 1.0 / blocks_mined,
+        'average_uncles': total_blocks_in_chain * 1.0 / length_of_chain - 1,
+        'block_time': rounds * 1.0 / length_of_chain,
+    }
+
+
+# One row per group, in order of group, from each group's total profit
+# and miner count. fields are added to every row, eg. the parameters the
+# payouts were worked out with; group_column names the group's column
+def group_rows(groupings, counts, baseline_group, stats, fields, group_column='group'):
+    base = groupings[baseline_group] / counts[baseline_group] \
+        if baseline_group in counts else float('nan')
+    rows = []
+    for group in sorted(counts):
+        row = dict(fields)
+        row.update(stats)
+        row.update({
+            group_column: group,
+            'miners': counts[group],
+            'profit': groupings[group] / counts[group],
+            'relative_profit': groupings[group] / counts[group] / base,
+        })
+        rows.append(row)
+    return rows
+
+
+# Print rows as a tab-separated table of the given columns
+def print_table(rows, columns, out=sys.stdout):
+    out.write('\t'.join(columns) + '\n')
+    for row in rows:
+        out.write('\t'.join([('%.4f' % row[c]) if isinstance(row[c], float) else str(row[c])
+                             for c in columns]) + '\n')
@@ -0,0 +1,30 @@
+import random
+import tracesink
+import ghost
+from powsampler import PowSampler
+
+tracesink.configure(tracesink.OFF)
+
+# Miners mining as far back as the uncle depth or further can't include
+# any uncles, as in the original simulator
+for uncle_depth in [2, 4]:
+    random.seed(uncle_depth)
+    dag, miners = ghost.simulate(uncle_depth=uncle_depth, rounds=50000)
+    backward = dict((m.id, m.backward) for m in miners)
+    for b in range(dag.genesis_blocks, len(dag)):
+        if backward[dag.makers[b]] >= uncle_depth:
+            assert dag.uncle_lists[b] == [], (b, dag.uncle_lists[b])
+
+print 'ghost.py uncles passed'
+
+# Miners without hashpower never find a block, and the others find them
+# in proportion to their hashpower
+random.seed(1)
+found = [0] * 4
+for t, i in PowSampler([0, 1, 0, 3], 40).blocks(100000):
+    found[i] += 1
+assert found[0] == found[2] == 0, found
+assert 0.9 < found[3] / (3.0 * found[1]) < 1.1, found
+assert list(PowSampler([0, 0], 10).blocks(100000)) == []
+
+print 'powsampler.py zero hashpower passed'
@@ -1,6 +1,7 @@
 import random
 import hashlib
 import sys
+import tracesink
 # Clock offset
 CLOCKOFFSET = 1
 # Block time
@@ -41,7 +42,8 @@ class Simulation():
                 m.listen()
             self.time += 1
             if i % (rounds // 100) == 0:
-                print 'Completed %d rounds out of %d' % (i, rounds)
+                tracesink.emit(tracesink.PROGRESS, 'round', round=i, rounds=rounds)
+        tracesink.flush()
     
     def get_validator(self, randao, skips):
         key = (randao << 32) + skips
@@ -173,7 +175,9 @@ class Validator():
             # Create the block
             b = Block(head, new_state, self.id, number=head.number + 1 + skips, skips=skips)
             self.created += 1
-            # print '---------> Validator %d makes block with hash %d and parent %d (%d skips) at time %d' % (self.id, b.hash, b.prevhash, skips, self.simulation.time)
+            if tracesink.level >= tracesink.EVENT:
+                tracesink.emit(tracesink.EVENT, 'block', validator=self.id, hash=b.hash, parent=b.prevhash,
+                               skips=skips, time=self.simulation.time)
             # Broadcast it
             for validator in self.simulation.validators:
                 recv_time = self.simulation.time + 1 + latency_sample(self.latency + validator.latency)
@@ -227,7 +231,8 @@ class Validator():
             # print 'too early, validator %d delaying %d (%d vs %d)' % (self.id, blk.hash, t, alotted_recv_time)
             return
         # Add the block and compute the score
-        # print 'Validator %d receives block, hash %d, time %d' % (self.id, blk.hash, self.simulation.time)
+        if tracesink.level >= tracesink.DETAIL:
+            tracesink.emit(tracesink.DETAIL, 'receive', validator=self.id, hash=blk.hash, time=self.simulation.time)
         self.blocks[blk.hash] = blk
         self.time_received[blk.hash] = t
         if blk.hash in self.orphans:
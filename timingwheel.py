@@ -0,0 +1,44 @@
+import heapq
+
+# A timing wheel for delivering things at a later tick: a ring of slots,
+# one per tick, each holding the items due at that tick in the order they
+# were scheduled. Scheduling an item and taking it when it is due are
+# both O(1), for items due less than `size` ticks after the last tick
+# taken; items due later than that wait in a heap until they come within
+# range.
+
+
+class TimingWheel():
+    def __init__(self, size):
+        self.size = size
+        self.slots = [[] for i in range(size)]
+        # The first tick whose items have not been taken yet
+        self.time = 0
+        # Heap of (tick, sequence number, item) for items due too far ahead
+        self.overflow = []
+        self.scheduled = 0
+
+    def schedule(self, t, item):
+        t = max(t, self.time)
+        if t < self.time + self.size:
+            self.slots[t % self.size].append(item)
+        else:
+            heapq.heappush(self.overflow, (t, self.scheduled, item))
+        self.scheduled += 1
+
+    # Take the items due at or before tick t, earliest first
+    def pop_due(self, t):
+        o = []
+        while self.time <= t:
+            while self.overflow and self.overflow[0][0] < self.time + self.size:
+                due, _, item = heapq.heappop(self.overflow)
+                self.slots[due % self.size].append(item)
+            i = self.time % self.size
+            if self.slots[i]:
+                o.extend(self.slots[i])
+                self.slots[i] = []
+            self.time += 1
+        return o
+
+    def __len__(self):
+        return sum([len(s) for s in self.slots]) + len(self.overflow)
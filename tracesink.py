@@ -0,0 +1,70 @@
+import atexit
+import json
+import os
+import sys
+
+# A trace sink shared by the simulators. Events go out buffered, either as
+# one JSON object per line to a file or as a line of text to stdout, and
+# events above the sink's level are dropped. Hot paths should check the
+# level before building an event, eg.
+#
+#     if tracesink.level >= tracesink.DETAIL:
+#         tracesink.emit(tracesink.DETAIL, 'tick', time=t)
+#
+# so that with tracing off all they cost is the comparison.
+#
+# The level and file can be set with the TRACE_LEVEL and TRACE_FILE
+# environment variables, or by calling configure().
+
+# Trace nothing
+OFF = 0
+# Periodic progress reports
+PROGRESS = 1
+# Per-block and per-confirmation events
+EVENT = 2
+# Per-tick and inner-loop details
+DETAIL = 3
+
+# Number of events to hold before writing them out
+BUFFER_SIZE = 1024
+
+level = OFF
+_out = sys.stdout
+_as_json = False
+_buffer = []
+
+
+# Trace events up to the given level, to a newline-delimited JSON file at
+# path if there is one, otherwise as text to stdout
+def configure(lvl, path=None):
+    global level, _out, _as_json
+    flush()
+    if _out is not sys.stdout:
+        _out.close()
+    level = lvl
+    _out = open(path, 'a') if path else sys.stdout
+    _as_json = bool(path)
+
+
+def emit(lvl, event, **fields):
+    if lvl > level:
+        return
+    if _as_json:
+        fields['event'] = event
+        _buffer.append(json.dumps(fields, sort_keys=True))
+    else:
+        _buffer.append(' '.join([event] + ['%s=%s' % (k, fields[k]) for k in sorted(fields)]))
+    # Progress reports on the terminal should show up as they happen
+    if len(_buffer) >= BUFFER_SIZE or (lvl <= PROGRESS and not _as_json):
+        flush()
+
+
+def flush():
+    if _buffer:
+        _out.write('\n'.join(_buffer) + '\n')
+        _out.flush()
+        del _buffer[:]
+
+
+atexit.register(flush)
+configure(int(os.environ.get('TRACE_LEVEL', PROGRESS)), os.environ.get('TRACE_FILE'))